@@ -7,9 +7,19 @@ import subprocess
 import sys
 import argparse
 import os
+import random
 import time
+import threading
 import re
+import socket
+import base64
+import json
+import traceback
 from pathlib import Path
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 try:
@@ -20,14 +30,270 @@ except ImportError:
 
 SCRIPT_DIR = Path(__file__).parent.absolute()
 CONFIG_FILE = SCRIPT_DIR / "lab.yaml"
+# JSON copy of the parsed lab.yaml, reused while lab.yaml is unchanged (much faster to load)
+CONFIG_CACHE_FILE = SCRIPT_DIR / "lab.yaml.json"
+SEPARATOR = "=" * 50
+
+# apt-get with built-in download retries and no pty per dpkg run;
+# eatmydata (when installed) skips dpkg's fsyncs, which dominate upgrade time and don't matter
+# in a throwaway build container
+APT_OPTS = "-o Acquire::Retries=3 -o Dpkg::Use-Pty=0"
+APT_GET = f"DEBIAN_FRONTEND=noninteractive $(command -v eatmydata) apt-get {APT_OPTS}"
+
+# Lab-wide apt defaults: no recommends/suggests (much smaller upgrades and installs), no pty per
+# dpkg run (also for plain `apt` calls) and no periodic apt-daily runs grabbing the dpkg lock while we provision
+APT_CONF = (
+    'APT::Install-Recommends "false";\n'
+    'APT::Install-Suggests "false";\n'
+    'Dpkg::Use-Pty "0";\n'
+    'APT::Periodic::Update-Package-Lists "0";\n'
+    'APT::Periodic::Unattended-Upgrade "0";\n'
+)
+APT_CONF_CMD = f"echo {base64.b64encode(APT_CONF.encode()).decode()} | base64 -d > /etc/apt/apt.conf.d/99-lab"
+# Keep downloaded .debs, only where the shared archive (proxmox.apt_archive_dir) is mounted
+APT_KEEP_DEBS_CMD = "echo 'APT::Keep-Downloaded-Packages \"true\";' > /etc/apt/apt.conf.d/99-lab-keep-debs"
+
+# Apt output signalling a mirror/proxy problem worth retrying another way
+APT_FETCH_ERROR_PATTERNS = ("Failed to fetch", "Unable to connect", "Unable to locate package")
+APT_FETCH_ERROR_RE = re.compile("|".join(re.escape(p) for p in APT_FETCH_ERROR_PATTERNS))
+# Remote filter passing back only the first few such lines instead of the whole apt log
+APT_FETCH_ERROR_FILTER = "grep -E '" + "|".join(APT_FETCH_ERROR_PATTERNS) + "' | head -5"
+
+# Docker's convenience install script, cached on the Proxmox host and pushed into containers
+GET_DOCKER_URL = "https://get.docker.com"
+GET_DOCKER_PATH = "/tmp/get-docker.sh"
+
+# Install Docker on a swarm node: get.docker.com (pushed from the host cache, downloaded only if
+# absent), falling back to the distribution's docker.io
+DOCKER_INSTALL_CMD = (
+    "rm -f /etc/apt/apt.conf.d/01proxy; "
+    "DEBIAN_FRONTEND=noninteractive apt update -qq 2>&1 && "
+    "if command -v curl >/dev/null 2>&1; then "
+    f"  ([ -s {GET_DOCKER_PATH} ] || curl -fsSL {GET_DOCKER_URL} -o {GET_DOCKER_PATH} 2>&1) && "
+    f"  sh {GET_DOCKER_PATH} 2>&1 | tail -20 || "
+    "  (echo 'get.docker.com failed, trying docker.io...' && "
+    "   DEBIAN_FRONTEND=noninteractive apt install -y docker.io 2>&1 | tail -20); "
+    "else "
+    "  echo 'curl not available, installing docker.io...'; "
+    "  DEBIAN_FRONTEND=noninteractive apt install -y docker.io 2>&1 | tail -20; "
+    "fi"
+)
+
+# Outcomes reported by `docker swarm init` / `docker swarm join`
+SWARM_OUTPUT_RE = re.compile(r"(?P<already>already part of a swarm)|(?P<joined>This node joined a swarm)|(?P<error>Error)")
+
+# A join token on its own line of `docker swarm join-token -q` output (daemon errors/warnings skipped)
+JOIN_TOKEN_RE = re.compile(r"(?m)^[ \t]*(?!Error|Warning)(\S{21,})[ \t\r]*$")
+
+# apt errors after which the install cannot succeed, so streaming output can stop early
+APT_FATAL_RE = re.compile(r"^E: (Unable to|Sub-process|Package .* has no installation candidate)")
+
+# ===STEP:name:rc=== lines printed by step_marker(); a non-numeric rc is reported as None
+STEP_MARKER_RE = re.compile(r"(?m)^[ \t]*===STEP:(.*):(\d*)[^:\n]*===[ \t\r]*$")
+
+# First apt error line in captured output (apt's logger/socket noise is not an install failure)
+APT_ERROR_RE = re.compile(r"(?m)^E: (?!.*(?:logger:|socket)).+$")
+
+# GLUSTER_BIN=/GLUSTERD= result lines printed after the GlusterFS install
+GLUSTER_STATE_RE = re.compile(r"(?m)^(GLUSTER_BIN|GLUSTERD)=(.*?)\s*$")
+
+# `pct start` output reporting a failure
+PCT_START_ERROR_RE = re.compile(r"error|failed|not found", re.IGNORECASE)
+
+# `gluster volume create` output on success
+GLUSTER_CREATE_SUCCESS_RE = re.compile(r"created|success", re.IGNORECASE)
+
+# Wait (up to __WAIT__ seconds) for apt/dpkg run by a freshly booted container (apt-daily,
+# unattended-upgrades) to finish; sleeps on inotify events on the dpkg lock when inotifywait is available
+APT_LOCK_WAIT_TMPL = (
+    "end=$((SECONDS+__WAIT__)); "
+    "while pgrep -x 'apt|apt-get|dpkg|unattended-upgr' >/dev/null && [ $SECONDS -lt $end ]; do "
+    "if command -v inotifywait >/dev/null 2>&1; then "
+    "timeout 5 inotifywait -qq -e close_write,delete_self /var/lib/dpkg/lock-frontend 2>/dev/null; "
+    "else sleep 1; fi; "
+    "done; "
+)
+APT_LOCK_WAIT_CMD = APT_LOCK_WAIT_TMPL.replace("__WAIT__", "120")
+
+# Move oracular sources to plucky (oracular is EOL) and enable universe/multiverse on plucky or noble
+FIX_SOURCES_CMD = (
+    "if grep -q oracular /etc/apt/sources.list; then "
+    "sed -i -e 's/oracular/plucky/g' "
+    "-e 's|old-releases.ubuntu.com|archive.ubuntu.com|g' "
+    "-e 's/plucky main/plucky main universe multiverse/g' "
+    "-e 's/plucky-updates main/plucky-updates main universe multiverse/g' "
+    "-e 's/plucky-security main/plucky-security main universe multiverse/g' /etc/apt/sources.list; "
+    "elif grep -q noble /etc/apt/sources.list; then "
+    "sed -i -e 's/noble main/noble main universe multiverse/g' "
+    "-e 's/noble-updates main/noble-updates main universe multiverse/g' "
+    "-e 's/noble-security main/noble-security main universe multiverse/g' /etc/apt/sources.list; "
+    "fi"
+)
+
+# apt-cacher-ng drop-in (read after acng.conf, so it overrides the packaged defaults)
+ACNG_CONF_PATH = "/etc/apt-cacher-ng/zz-lab.conf"
+ACNG_CONF_TEMPLATE = """# Managed by lab.py
+Port: {port}
+"""
+
+# HAProxy ports used when the container params do not set them
+HAPROXY_DEFAULT_PORTS = {'http_port': 80, 'https_port': 443, 'stats_port': 8404}
+
+# One HAProxy backend server line per swarm node
+HAPROXY_SERVER_LINE = "    server node{idx} {ip}:80 check"
+
+# /etc/haproxy/haproxy.cfg; backend_servers is one HAPROXY_SERVER_LINE per swarm node
+HAPROXY_CONFIG_TEMPLATE = """global
+    log /dev/log local0
+    log /dev/log local1 notice
+    chroot /var/lib/haproxy
+    stats socket /run/haproxy/admin.sock mode 660 level admin
+    stats timeout 30s
+    user haproxy
+    group haproxy
+    daemon
+
+defaults
+    log global
+    mode http
+    option httplog
+    option dontlognull
+    timeout connect 5000ms
+    timeout client 50000ms
+    timeout server 50000ms
+    errorfile 400 /etc/haproxy/errors/400.http
+    errorfile 403 /etc/haproxy/errors/403.http
+    errorfile 408 /etc/haproxy/errors/408.http
+    errorfile 500 /etc/haproxy/errors/500.http
+    errorfile 502 /etc/haproxy/errors/502.http
+    errorfile 503 /etc/haproxy/errors/503.http
+    errorfile 504 /etc/haproxy/errors/504.http
+
+# Stats page
+listen stats
+    bind *:{stats_port}
+    stats enable
+    stats uri /
+    stats refresh 30s
+    stats admin if TRUE
+
+# Frontend for HTTP
+frontend http_frontend
+    bind *:{http_port}
+    default_backend swarm_backend
+
+# Frontend for HTTPS
+frontend https_frontend
+    bind *:{https_port}
+    default_backend swarm_backend
+
+# Backend for Docker Swarm nodes
+backend swarm_backend
+    balance roundrobin
+    option httpchk GET /
+    http-check expect status 200
+{backend_servers}
+"""
+
+# pct_exec keeps only the last 64 KiB of captured output, read in chunks of up to 8 KiB
+CAPTURE_CHUNK_SIZE = 8192
+CAPTURE_MAX_BYTES = 64 * 1024
+
+# Held while known_hosts is rewritten, as containers are now set up from several threads
+_KNOWN_HOSTS_LOCK = threading.Lock()
+
+# host -> connected paramiko.SSHClient, shared by all threads (each exec opens its own channel)
+_SSH_CLIENTS = {}
+_SSH_CLIENTS_LOCK = threading.Lock()
+# Channels open at once on the shared connection; sshd refuses sessions beyond MaxSessions (default 10)
+_SSH_SESSION_SLOTS = threading.BoundedSemaphore(8)
+
+# container_id -> (time.monotonic() of last successful apt update, its output)
+_APT_UPDATE_CACHE = {}
+# container_id -> time.monotonic() when an apt command last completed there (no lock held since)
+_APT_LOCK_CLEAN = {}
 
 try:
     import yaml
     HAS_YAML = True
+    # libyaml's C loader when PyYAML was built with it; same safe semantics, several times faster
+    _YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 except ImportError:
     HAS_YAML = False
 
 
+class ThreadPrefixedStream:
+    """Wrap a text stream so whole lines written by a thread with a prefix set start with that prefix.
+    
+    Every thread's output is line-buffered, prefixed or not, so lines from parallel threads never merge.
+    """
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+    
+    def get_prefix(self):
+        return getattr(self.local, 'prefix', None)
+    
+    def set_prefix(self, prefix):
+        pending = getattr(self.local, 'pending', "")
+        if pending:
+            self.stream.write(f"{self.get_prefix() or ''}{pending}\n")
+        self.local.prefix = prefix
+        self.local.pending = ""
+    
+    def write(self, text):
+        prefix = self.get_prefix() or ""
+        # Hold partial lines back until their newline arrives
+        *lines, self.local.pending = (getattr(self.local, 'pending', "") + text).split("\n")
+        if lines:
+            self.stream.write("".join(f"{prefix}{line}\n" for line in lines))
+        return len(text)
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def prefixed_output():
+    """Route stdout/stderr through ThreadPrefixedStream for the duration, for run_prefixed workers"""
+    saved = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadPrefixedStream(sys.stdout), ThreadPrefixedStream(sys.stderr)
+    try:
+        yield
+    finally:
+        # Flush this thread's partial line before restoring the real streams
+        for stream in (sys.stdout, sys.stderr):
+            stream.set_prefix(None)
+        sys.stdout, sys.stderr = saved
+
+
+def run_prefixed(prefix, func, *args, **kwargs):
+    """Call func, prefixing each line it prints from this thread (inside prefixed_output())"""
+    streams = [stream for stream in (sys.stdout, sys.stderr) if isinstance(stream, ThreadPrefixedStream)]
+    for stream in streams:
+        stream.set_prefix(prefix)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        for stream in streams:
+            stream.set_prefix(None)
+
+
+def inherit_prefix(func):
+    """Wrap func so that, run on another thread, it prints under the calling thread's prefix"""
+    if not isinstance(sys.stdout, ThreadPrefixedStream):
+        return func
+    prefix = sys.stdout.get_prefix()
+    return lambda *args, **kwargs: run_prefixed(prefix, func, *args, **kwargs)
+
+
+def print_banner(title, leading_newline=False):
+    """Print a section banner framed by SEPARATOR lines in a single write"""
+    prefix = "\n" if leading_newline else ""
+    print(f"{prefix}{SEPARATOR}\n{title}\n{SEPARATOR}")
+
+
 def load_config():
     """Load configuration from lab.yaml"""
     if not CONFIG_FILE.exists():
@@ -36,8 +302,14 @@ def load_config():
     
     try:
         if HAS_YAML:
-            with open(CONFIG_FILE, 'r') as f:
-                config = yaml.safe_load(f)
+            # Reuse the JSON sidecar while lab.yaml is unchanged (same mtime and size)
+            stat = CONFIG_FILE.stat()
+            key = (stat.st_mtime_ns, stat.st_size)
+            config = load_config_sidecar(key)
+            if config is None:
+                with open(CONFIG_FILE, 'r') as f:
+                    config = yaml.load(f, Loader=_YAML_LOADER)
+                write_config_sidecar(key, config)
             return config
         else:
             print("Error: PyYAML is required. Install it with: pip install pyyaml", file=sys.stderr)
@@ -47,6 +319,36 @@ def load_config():
         sys.exit(1)
 
 
+def load_config_sidecar(key):
+    """Return the config from CONFIG_CACHE_FILE if it was written for this lab.yaml (mtime, size), else None"""
+    try:
+        with open(CONFIG_CACHE_FILE, 'r') as f:
+            sidecar = json.load(f)
+        if sidecar.get('source') == list(key):
+            return sidecar['config']
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass  # Missing or corrupt - parse the YAML instead
+    return None
+
+
+def write_config_sidecar(key, config):
+    """Atomically write the parsed config to CONFIG_CACHE_FILE (best effort)"""
+    tmp_path = CONFIG_CACHE_FILE.with_name(f"{CONFIG_CACHE_FILE.name}.{os.getpid()}.tmp")
+    try:
+        data = json.dumps({'source': list(key), 'config': config})
+        if json.loads(data)['config'] != config:
+            return  # e.g. non-string keys, which JSON would silently turn into strings
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, CONFIG_CACHE_FILE)
+    except (OSError, TypeError, ValueError):
+        # Read-only checkout or a value JSON cannot hold; the YAML stays the source of truth
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
 def get_network_base(network_cidr):
     """Extract network base from CIDR notation (e.g., 10.11.3.0/24 -> 10.11.3)"""
     network = network_cidr.split('/')[0]
@@ -78,6 +380,11 @@ def get_config():
             ct_copy['ip_address'] = build_ip(ct['ip'])
             containers.append(ct_copy)
     
+    # Index containers by type once instead of rescanning the list at each use
+    containers_by_type = {}
+    for ct in containers:
+        containers_by_type.setdefault(ct['type'], []).append(ct)
+    
     # Build swarm info from containers
     swarm_managers = []
     swarm_workers = []
@@ -101,14 +408,22 @@ def get_config():
         'proxmox_storage': config['proxmox']['storage'],
         'proxmox_bridge': config['proxmox']['bridge'],
         'proxmox_template_dir': config['proxmox']['template_dir'],
+        'proxmox_cache_dir': config['proxmox'].get('cache_dir', '/var/cache/lab'),
+        'proxmox_apt_archive_dir': config['proxmox'].get('apt_archive_dir'),
+        'parallel_builds': max(1, int(config['proxmox'].get('parallel_builds', 4))),
         'network': config['network'],
         'network_base': network_base,
         'gateway': gateway,
         'containers': containers,
+        'containers_by_type': containers_by_type,
         'swarm_managers': swarm_managers,
         'swarm_workers': swarm_workers,
+        'swarm_nodes': tuple(swarm_managers + swarm_workers),
         'templates': config['templates'],
         'template_config': config.get('template_config', {}),
+        # find(1) arguments excluding the preserved template archives, built once
+        'template_preserve_args': " ".join(f"! -name '{p}'"
+                                           for p in config.get('template_config', {}).get('preserve', [])),
         'swarm_port': config['services']['docker_swarm']['port'],
         'portainer_port': config['services']['portainer']['port'],
         'portainer_image': config['services']['portainer']['image'],
@@ -122,55 +437,82 @@ def get_config():
         'ssh': config['ssh'],
         'waits': config['waits'],
         'glusterfs': config.get('glusterfs', {}),
+        'verify_strict': bool(config.get('verify_strict', False)),
+        'stream_output': bool(config.get('stream_output', False)),
         'apt-cache-ct': config.get('apt-cache-ct', 'apt-cache')
     }
 
 
+def get_ssh_client(host, cfg):
+    """Return the paramiko client for host, connecting on first use; each call then only opens a channel"""
+    with _SSH_CLIENTS_LOCK:
+        client = _SSH_CLIENTS.get(host)
+        transport = client.get_transport() if client else None
+        if transport is not None and transport.is_active():
+            return client
+        # Parse host (format: user@host or just host)
+        if '@' in host:
+            username, hostname = host.split('@', 1)
+        else:
+            username = 'root'
+            hostname = host
+        connect_timeout = cfg.get('ssh', {}).get('connect_timeout', 10)
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(
+            hostname=hostname,
+            username=username,
+            timeout=connect_timeout,
+            banner_timeout=connect_timeout,
+            auth_timeout=connect_timeout,
+            look_for_keys=True,
+            allow_agent=True
+        )
+        client.get_transport().set_keepalive(30)
+        _SSH_CLIENTS[host] = client
+        return client
+
+
+def evict_ssh_client(host):
+    """Drop and close the cached paramiko client for host, so the next call reconnects"""
+    with _SSH_CLIENTS_LOCK:
+        client = _SSH_CLIENTS.pop(host, None)
+    if client:
+        client.close()
+
+
+def close_ssh_clients():
+    """Close the cached paramiko connections"""
+    with _SSH_CLIENTS_LOCK:
+        for client in _SSH_CLIENTS.values():
+            client.close()
+        _SSH_CLIENTS.clear()
+
+
 def ssh_exec(host, command, check=True, capture_output=False, timeout=None, cfg=None):
     """Execute command via SSH using paramiko if available, fallback to subprocess"""
     if HAS_PARAMIKO and cfg:
         try:
-            # Parse host (format: user@host or just host)
-            if '@' in host:
-                username, hostname = host.split('@', 1)
-            else:
-                username = 'root'
-                hostname = host
-            
-            connect_timeout = cfg.get('ssh', {}).get('connect_timeout', 10)
             exec_timeout = timeout if timeout else 300
-            
-            # Create SSH client
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
-            # Connect
-            client.connect(
-                hostname=hostname,
-                username=username,
-                timeout=connect_timeout,
-                look_for_keys=True,
-                allow_agent=True
-            )
+            client = get_ssh_client(host, cfg)
             
             # Execute command
-            stdin, stdout, stderr = client.exec_command(command, timeout=exec_timeout)
-            
-            # Get exit status
-            exit_status = stdout.channel.recv_exit_status()
+            with _SSH_SESSION_SLOTS:
+                stdin, stdout, stderr = client.exec_command(command, timeout=exec_timeout)
+                
+                # Get exit status
+                exit_status = stdout.channel.recv_exit_status()
+                output = stdout.read()
+                stderr.read()
             
             if capture_output:
-                output = stdout.read().decode('utf-8').strip()
-                error_output = stderr.read().decode('utf-8').strip()
-                client.close()
+                output = output.decode('utf-8').strip()
+                # Same contract as the subprocess path: a failed checked command yields None
+                # (raising here would be caught below and re-run the command over ssh)
                 if exit_status != 0 and check:
-                    raise subprocess.CalledProcessError(exit_status, command, output, error_output)
+                    return None
                 return output
             else:
-                # For non-capture mode, read output to prevent buffer issues
-                stdout.read()
-                stderr.read()
-                client.close()
                 if exit_status != 0 and check:
                     raise subprocess.CalledProcessError(exit_status, command)
                 return exit_status == 0
@@ -191,60 +533,291 @@ def ssh_exec(host, command, check=True, capture_output=False, timeout=None, cfg=
                 return False
     
     # Fallback to subprocess if paramiko not available or failed
-    connect_timeout = cfg['ssh']['connect_timeout'] if cfg and 'ssh' in cfg else 10
-    batch_mode = 'yes' if (cfg and cfg.get('ssh', {}).get('batch_mode', True)) else 'no'
-    cmd = f'ssh -o ConnectTimeout={connect_timeout} -o BatchMode={batch_mode} {host} "{command}"'
+    cmd = f'ssh {ssh_options(cfg)} {host} "{command}"'
+    # In a run_prefixed worker, pass uncaptured output through sys.stdout so it gets the prefix too
+    relay = not capture_output and isinstance(sys.stdout, ThreadPrefixedStream)
     try:
         result = subprocess.run(
             cmd,
             shell=True,
-            check=check,
+            check=False,
             capture_output=capture_output,
+            stdout=subprocess.PIPE if relay else None,
+            stderr=subprocess.STDOUT if relay else None,
             text=True,
             timeout=timeout
         )
-        if capture_output:
-            return result.stdout.strip()
-        return result.returncode == 0
     except subprocess.TimeoutExpired:
         if capture_output:
             return None
         return False
-    except subprocess.CalledProcessError:
-        if capture_output:
+    if capture_output:
+        if check and result.returncode != 0:
             return None
+        return result.stdout.strip()
+    if relay and result.stdout:
+        sys.stdout.write(result.stdout)
+    return result.returncode == 0
+
+
+def ssh_options(cfg=None):
+    """ssh options for Proxmox host calls; with ssh.multiplex, one connection per host is kept open and reused"""
+    ssh_cfg = cfg.get('ssh', {}) if cfg else {}
+    connect_timeout = ssh_cfg.get('connect_timeout', 10)
+    batch_mode = 'yes' if ssh_cfg.get('batch_mode', True) else 'no'
+    options = f"-o ConnectTimeout={connect_timeout} -o BatchMode={batch_mode}"
+    if ssh_cfg.get('multiplex', True):
+        options += " -o ControlMaster=auto -o ControlPath=~/.ssh/lab-cm-%r@%h:%p -o ControlPersist=600"
+    return options
+
+
+def ensure_ssh_master(host, cfg=None):
+    """Open the multiplexed SSH master connection up front, so parallel first calls share one connection"""
+    if cfg and not cfg.get('ssh', {}).get('multiplex', True):
+        return False
+    # ControlPath lives in ~/.ssh; ssh refuses to multiplex if the directory is missing
+    os.makedirs(os.path.expanduser("~/.ssh"), mode=0o700, exist_ok=True)
+    options = ssh_options(cfg)
+    if subprocess.run(f"ssh {options} -O check {host}", shell=True, capture_output=True).returncode == 0:
+        return True
+    try:
+        return subprocess.run(f"ssh {options} -N -f {host}", shell=True, capture_output=True,
+                              timeout=30).returncode == 0
+    except subprocess.TimeoutExpired:
         return False
 
 
-def pct_exec(proxmox_host, container_id, command, check=True, capture_output=False, timeout=30, cfg=None):
-    """Execute command in container via pct exec"""
+def stop_ssh_master(host, cfg=None):
+    """Close the multiplexed SSH master connection (otherwise it lingers for ControlPersist)"""
+    if cfg and not cfg.get('ssh', {}).get('multiplex', True):
+        return
+    subprocess.run(f"ssh {ssh_options(cfg)} -O stop {host}", shell=True, capture_output=True)
+
+
+def pct_exec_command(proxmox_host, container_id, command, cfg=None):
+    """Build the ssh argv running command in a container via pct exec (run without a local shell)"""
     # Use base64 encoding to avoid quote escaping issues
-    import base64
     encoded_cmd = base64.b64encode(command.encode()).decode()
     # Decode and execute via bash
-    connect_timeout = cfg['ssh']['connect_timeout'] if cfg and 'ssh' in cfg else 10
-    batch_mode = 'yes' if (cfg and cfg['ssh'].get('batch_mode', True)) else 'no'
-    cmd = f"ssh -o ConnectTimeout={connect_timeout} -o BatchMode={batch_mode} {proxmox_host} 'pct exec {container_id} -- bash -c \"echo {encoded_cmd} | base64 -d | bash\"'"
+    return ["ssh", *ssh_options(cfg).split(), proxmox_host,
+            f"pct exec {container_id} -- bash -c \"echo {encoded_cmd} | base64 -d | bash\""]
+
+
+def pct_exec(proxmox_host, container_id, command, check=True, capture_output=False, timeout=30, cfg=None):
+    """Execute command in container via pct exec"""
+    cmd = pct_exec_command(proxmox_host, container_id, command, cfg)
+    if capture_output and HAS_PARAMIKO and cfg:
+        try:
+            return paramiko_exec_tail(proxmox_host, cmd[-1], check, timeout, cfg)
+        except Exception:
+            # Not started (stale or refused connection): reconnect next time, run this one over ssh
+            evict_ssh_client(proxmox_host)
+    if capture_output:
+        return pct_exec_tail(cmd, check, timeout)
+    # In a run_prefixed worker, pass the output through sys.stdout so it gets the prefix too
+    relay = isinstance(sys.stdout, ThreadPrefixedStream)
     try:
         result = subprocess.run(
             cmd,
-            shell=True,
-            check=check,
-            capture_output=capture_output,
-        text=True,
-        timeout=timeout
+            check=False,
+            stdout=subprocess.PIPE if relay else None,
+            stderr=subprocess.STDOUT if relay else None,
+            text=True,
+            timeout=timeout
         )
-        if capture_output:
-            return result.stdout.strip()
-        return result.returncode == 0
     except subprocess.TimeoutExpired:
-        if capture_output:
-            return None
         return False
-    except subprocess.CalledProcessError:
-        if capture_output:
+    if relay and result.stdout:
+        sys.stdout.write(result.stdout)
+    # Inspect the exit code directly rather than raising and catching CalledProcessError
+    return result.returncode == 0
+
+
+def pct_exec_tail(cmd, check, timeout):
+    """Run cmd keeping only the last CAPTURE_MAX_BYTES of stdout; None on timeout or checked failure"""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    timed_out = threading.Event()
+    
+    def kill():
+        timed_out.set()
+        proc.kill()
+    
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output = read_tail(lambda: proc.stdout.read1(CAPTURE_CHUNK_SIZE))
+        proc.wait()
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+    if timed_out.is_set() or (check and proc.returncode != 0):
+        return None
+    return output
+
+
+def paramiko_exec_tail(host, command, check, timeout, cfg):
+    """pct_exec_tail over the cached paramiko connection.
+    
+    Raises only if the command could not be started (so the caller may safely run it over ssh
+    instead); once it has started, any failure returns None like a timeout.
+    """
+    client = get_ssh_client(host, cfg)
+    with _SSH_SESSION_SLOTS:
+        channel = client.get_transport().open_session()
+        try:
+            channel.settimeout(0.1)
+            channel.exec_command(command)
+        except Exception:
+            channel.close()
+            raise
+        deadline = time.monotonic() + timeout
+        
+        def read_chunk():
+            while True:
+                if time.monotonic() > deadline:
+                    raise TimeoutError
+                # Discard stderr as pct_exec_tail does, draining it so its window never stalls the command
+                while channel.recv_stderr_ready():
+                    channel.recv_stderr(CAPTURE_CHUNK_SIZE)
+                try:
+                    return channel.recv(CAPTURE_CHUNK_SIZE)
+                except socket.timeout:
+                    continue
+        
+        try:
+            output = read_tail(read_chunk)
+            exit_status = channel.recv_exit_status()
+        except TimeoutError:
+            return None
+        except Exception:
+            # The command may already have run, so it is not retried; reconnect next time
+            evict_ssh_client(host)
             return None
+        finally:
+            channel.close()
+    if check and exit_status != 0:
+        return None
+    return output
+
+
+def read_tail(read_chunk):
+    """Call read_chunk until it returns b'', keeping only the last CAPTURE_MAX_BYTES; return the decoded tail"""
+    chunks = deque()
+    size = 0
+    truncated = False
+    for chunk in iter(read_chunk, b""):
+        chunks.append(chunk)
+        size += len(chunk)
+        while size - len(chunks[0]) >= CAPTURE_MAX_BYTES:
+            size -= len(chunks.popleft())
+            truncated = True
+    return capture_tail(b"".join(chunks), truncated)
+
+
+def capture_tail(data, truncated):
+    """Decode the kept end of captured output; when cut, drop the partial first line"""
+    output = data.decode(errors="replace")
+    if truncated:
+        output = output.partition("\n")[2]
+    return output.strip()
+
+
+def pct_exec_stream(proxmox_host, container_id, command, abort_pattern=None, max_lines=200, timeout=300, cfg=None):
+    """Run command in container, reading output as it arrives; stop early when abort_pattern matches a line.
+    
+    Returns (output, aborted), where output holds at most the last max_lines lines. With
+    stream_output set, every line is also printed live, prefixed with the container ID.
+    """
+    echo = bool(cfg and cfg.get('stream_output'))
+    proc = subprocess.Popen(pct_exec_command(proxmox_host, container_id, command, cfg),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, text=True)
+    # Readline blocks, so enforce the timeout by killing the process from a timer
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    lines = deque(maxlen=max_lines)
+    aborted = False
+    try:
+        for line in proc.stdout:
+            lines.append(line)
+            if echo:
+                print(f"  [{container_id}] {line.rstrip()}", flush=True)
+            if abort_pattern and abort_pattern.search(line):
+                aborted = True
+                proc.terminate()
+                break
+        proc.wait()
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+    return "".join(lines).strip(), aborted
+
+
+def pct_push_content(proxmox_host, container_id, content, dest, perms="0644", cfg=None):
+    """Write content to dest in a container: streamed to a host temp file over ssh stdin, then pct push"""
+    remote = (f"tmp=$(mktemp) && cat > $tmp && pct push {container_id} $tmp {dest} --perms {perms}; "
+              "rc=$?; rm -f $tmp; exit $rc")
+    try:
+        result = subprocess.run(f"ssh {ssh_options(cfg)} {proxmox_host} '{remote}'", shell=True,
+                                input=content, text=True, capture_output=True, timeout=60)
+    except subprocess.TimeoutExpired:
         return False
+    return result.returncode == 0
+
+
+def push_cached_download(proxmox_host, container_id, url, name, dest, max_age_days=7, cfg=None):
+    """Download url once into the host cache_dir (refreshed after max_age_days) and push it to dest"""
+    cache_dir = cfg['proxmox_cache_dir'] if cfg else "/var/cache/lab"
+    cache_file = f"{cache_dir}/{name}"
+    # Parallel builders share cache_file, so the freshness check and download run under a lock;
+    # waiters then find the fresh file instead of overwriting the same .tmp
+    cached = ssh_exec(proxmox_host,
+                      f"mkdir -p {cache_dir}; "
+                      f"flock {cache_file}.lock -c '"
+                      f"find {cache_file} -mtime -{max_age_days} 2>/dev/null | grep -q . || "
+                      f"{{ curl -fsSL {url} -o {cache_file}.tmp && mv {cache_file}.tmp {cache_file}; }}'; "
+                      f"[ -s {cache_file} ] && pct push {container_id} {cache_file} {dest} && echo pushed",
+                      check=False, capture_output=True, timeout=120, cfg=cfg)
+    return output_token(cached) == "pushed"
+
+
+def run_concurrently(steps, max_workers=4):
+    """Run independent (description, callable) steps in parallel, return {description: result}"""
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for description, func in steps:
+            print(f"{description}...", flush=True)
+            futures[executor.submit(inherit_prefix(func))] = description
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def step_marker(name):
+    """Shell snippet printing the exit code of the previous command as a ===STEP:name:rc=== line"""
+    return f"echo \"===STEP:{name}:$?===\""
+
+
+def parse_step_markers(output):
+    """Return {name: exit code} from the ===STEP:name:rc=== lines in output"""
+    return {name: int(code) if code else None
+            for name, code in STEP_MARKER_RE.findall(output or "")}
+
+
+def run_batched_steps(proxmox_host, container_id, steps, timeout=60, cfg=None):
+    """Run (name, command) steps in one pct_exec, return {name: exit code} parsed from step markers"""
+    script = "set +e\n" + "\n".join(
+        f"( {command} ) >/dev/null 2>&1; {step_marker(name)}" for name, command in steps
+    )
+    output = pct_exec(proxmox_host, container_id, script, check=False, capture_output=True, timeout=timeout, cfg=cfg)
+    results = parse_step_markers(output)
+    for name, _ in steps:
+        code = results.get(name)
+        if code is None:
+            print(f"  ⚠ {name}: no result (batch did not complete)", flush=True)
+        elif code != 0:
+            print(f"  ⚠ {name}: exited with status {code}", flush=True)
+    return results
 
 
 def container_exists(proxmox_host, container_id, cfg=None):
@@ -254,12 +827,107 @@ def container_exists(proxmox_host, container_id, cfg=None):
     return result is not None and container_id_str in result
 
 
+def backoff_delay(attempt, base_delay, max_delay=60):
+    """Exponential backoff for 1-based attempt, capped at max_delay, plus up to base_delay/2 of jitter"""
+    return min(max_delay, base_delay * 2 ** (attempt - 1)) + random.uniform(0, base_delay * 0.5)
+
+
+def output_token(output):
+    """Return the first line of a probe's output, stripped (e.g. 'active', 'port_open')"""
+    if not output:
+        return ""
+    return output.strip().split('\n', 1)[0].strip()
+
+
+def service_is_active(output):
+    """Check `systemctl is-active` output exactly ('inactive' must not match 'active')"""
+    return output_token(output) == "active"
+
+
+def wait_for_service_active(proxmox_host, container_id, service, attempts=4, base_delay=0.5, max_delay=60, cfg=None):
+    """Probe a systemd unit immediately, retrying with exponential backoff (capped at max_delay) until it is active"""
+    for attempt in range(attempts):
+        status = pct_exec(proxmox_host, container_id,
+                          f"systemctl is-active {service} 2>/dev/null || echo inactive",
+                          check=False, capture_output=True, timeout=10, cfg=cfg)
+        if service_is_active(status):
+            return True
+        if attempt < attempts - 1:
+            time.sleep(min(max_delay, base_delay * 2 ** attempt))
+    return False
+
+
+def apt_update(proxmox_host, container_id, max_age=60, timeout=240, cfg=None):
+    """Run apt update in the container unless one succeeded there within max_age seconds"""
+    if apt_update_is_fresh(container_id, max_age):
+        print("  Package lists are fresh, skipping apt update", flush=True)
+        return _APT_UPDATE_CACHE[container_id][1]
+    output = pct_exec(proxmox_host, container_id,
+                      apt_lock_wait_cmd(container_id) +
+                      f"{APT_GET} update -y 2>&1 | tail -10; "
+                      "[ ${PIPESTATUS[0]} -eq 0 ] && echo apt_update_ok",
+                      check=False, capture_output=True, timeout=timeout, cfg=cfg)
+    if output and output.rstrip().endswith("apt_update_ok"):
+        _APT_UPDATE_CACHE[container_id] = (time.monotonic(), output)
+        _APT_LOCK_CLEAN[container_id] = time.monotonic()
+    else:
+        forget_apt_update(container_id)
+    return output
+
+
+def dpkg_installed_cmd(package):
+    """Shell test that succeeds if dpkg records package as installed (no output)"""
+    return f"dpkg-query -W -f='${{Status}}\\n' {package} 2>/dev/null | grep -q 'install ok installed'"
+
+
+def apt_proxy_cmd(cfg):
+    """Command pointing apt at the apt-cache container via 01proxy, or '' if none is configured"""
+    apt_cache_containers = cfg['containers_by_type'].get('apt-cache', [])
+    if not apt_cache_containers:
+        return ""
+    apt_cache_ip = apt_cache_containers[0]['ip_address']
+    return (f"echo 'Acquire::http::Proxy \"http://{apt_cache_ip}:{cfg['apt_cache_port']}\";' "
+            "> /etc/apt/apt.conf.d/01proxy")
+
+
+def apt_update_is_fresh(container_id, max_age=60):
+    """Check whether apt update succeeded in the container within max_age seconds"""
+    cached = _APT_UPDATE_CACHE.get(container_id)
+    return cached is not None and time.monotonic() - cached[0] < max_age
+
+
+def apt_lock_wait_cmd(container_id, max_age=30, wait_seconds=120):
+    """Lock wait waiting up to wait_seconds, or '' if apt completed in the container within max_age seconds"""
+    if time.monotonic() - _APT_LOCK_CLEAN.get(container_id, float('-inf')) < max_age:
+        return ""
+    if wait_seconds == 120:
+        return APT_LOCK_WAIT_CMD
+    return APT_LOCK_WAIT_TMPL.replace("__WAIT__", str(int(wait_seconds)))
+
+
+def forget_apt_update(container_id):
+    """Drop the cached apt update result for a container (destroyed or sources changed)"""
+    _APT_UPDATE_CACHE.pop(container_id, None)
+    _APT_LOCK_CLEAN.pop(container_id, None)
+
+
+def probe_key_values(proxmox_host, container_id, script, timeout=30, cfg=None):
+    """Run a probe script printing KEY=VALUE lines in one pct_exec, return them as a dict"""
+    output = pct_exec(proxmox_host, container_id, script, check=False, capture_output=True, timeout=timeout, cfg=cfg)
+    values = {}
+    for line in (output or "").split('\n'):
+        key, sep, value = line.strip().partition('=')
+        if sep:
+            values[key] = value
+    return values
+
+
 def destroy_container(proxmox_host, container_id, cfg=None):
     """Destroy container if it exists"""
+    forget_apt_update(container_id)
     # Check if container exists
     container_id_str = str(container_id)
-    check_result = ssh_exec(proxmox_host, f"pct list | grep '^{container_id_str} '", check=False, capture_output=True, cfg=cfg)
-    if not check_result or container_id_str not in check_result:
+    if not container_exists(proxmox_host, container_id, cfg=cfg):
         print(f"  Container {container_id} does not exist, skipping", flush=True)
         return
     
@@ -276,24 +944,59 @@ def destroy_container(proxmox_host, container_id, cfg=None):
         print(f"  ⚠ Container {container_id_str} still exists, forcing destruction...", flush=True)
         ssh_exec(proxmox_host, f"pct destroy {container_id_str} --force 2>&1 || true", check=False, cfg=cfg)
         time.sleep(1)
+        # Final verification (only needed after a forced destroy)
+        verify_result = ssh_exec(proxmox_host, f"pct list | grep '^{container_id_str} '", check=False, capture_output=True, cfg=cfg)
     
-    # Final verification
-    final_check = ssh_exec(proxmox_host, f"pct list | grep '^{container_id_str} '", check=False, capture_output=True, cfg=cfg)
-    if not final_check or container_id_str not in final_check:
+    if not verify_result or container_id_str not in verify_result:
         print(f"  ✓ Container {container_id_str} destroyed", flush=True)
     else:
         print(f"  ✗ Container {container_id_str} still exists after destruction attempt", flush=True)
 
 
+def dns_config_cmd(dns_servers):
+    """Write resolv.conf with one nameserver line per server in a single printf"""
+    return f"printf 'nameserver %s\\n' {' '.join(dns_servers)} > /etc/resolv.conf"
+
+
+def network_setup_cmd(ip_address, gateway):
+    """Bring up eth0 with the address and default route, retrying in-shell; prints network_ok or network_failed"""
+    return (
+        "for i in 1 2 3; do "
+        f"ip link set eth0 up; ip addr add {ip_address}/24 dev eth0 2>/dev/null; "
+        f"ip route add default via {gateway} dev eth0 2>/dev/null; "
+        f"ip addr show eth0 | grep -q ' {ip_address}/' && ip route | grep -q 'default via {gateway}' "
+        "&& { echo network_ok; exit 0; }; "
+        "sleep 1; done; echo network_failed"
+    )
+
+
+def user_setup_cmd(cfg):
+    """Create the default user with passwordless sudo and an empty ~/.ssh (idempotent)"""
+    default_user = cfg['users']['default_user']
+    sudo_group = cfg['users']['sudo_group']
+    return (
+        f"useradd -m -s /bin/bash -G {sudo_group} {default_user} 2>/dev/null || echo User exists; "
+        f"echo '{default_user} ALL=(ALL) NOPASSWD: ALL' | tee /etc/sudoers.d/{default_user}; "
+        f"chmod 440 /etc/sudoers.d/{default_user}; "
+        f"mkdir -p /home/{default_user}/.ssh; chown -R {default_user}:{default_user} /home/{default_user}; chmod 700 /home/{default_user}/.ssh"
+    )
+
+
 def wait_for_container(proxmox_host, container_id, ip_address, max_attempts=None, sleep_interval=None, cfg=None):
     """Wait for container to be ready"""
     if max_attempts is None:
         max_attempts = cfg['waits']['container_ready_max_attempts'] if cfg and 'waits' in cfg else 30
     if sleep_interval is None:
         sleep_interval = cfg['waits']['container_ready_sleep'] if cfg and 'waits' in cfg else 3
-    for i in range(1, max_attempts + 1):
+    # Same overall budget as max_attempts fixed sleeps, but poll quickly at first and back off
+    # to sleep_interval, so a container that is already up is noticed within a fraction of a second
+    deadline = time.monotonic() + max_attempts * sleep_interval
+    delay = min(0.25, sleep_interval)
+    attempt = 0
+    while True:
+        attempt += 1
         status = ssh_exec(proxmox_host, f"pct status {container_id} 2>&1", check=False, capture_output=True, cfg=cfg)
-        if 'running' in status:
+        if status and 'running' in status:
             # Try ping
             try:
                 ping_result = subprocess.run(
@@ -332,15 +1035,20 @@ def wait_for_container(proxmox_host, container_id, ip_address, max_attempts=None
             except (subprocess.TimeoutExpired, Exception):
                 pass
         
-        print(f"Waiting... ({i}/{max_attempts})")
-        time.sleep(sleep_interval)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        print(f"Waiting... (attempt {attempt}, {remaining:.0f}s left)")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, sleep_interval)
     
     print("WARNING: Container may not be fully ready, but continuing...")
     return True  # Continue anyway
 
 
+@lru_cache(maxsize=None)
 def get_ssh_key():
-    """Get SSH public key"""
+    """Get SSH public key (read once per run)"""
     key_paths = [
         Path.home() / ".ssh" / "id_rsa.pub",
         Path.home() / ".ssh" / "id_ed25519.pub"
@@ -351,26 +1059,36 @@ def get_ssh_key():
     return ""
 
 
-def setup_ssh_key(proxmox_host, container_id, ip_address, cfg=None):
-    """Setup SSH key in container"""
+def ssh_key_cmd(cfg=None):
+    """Build the command installing the local public key for the default user and root ('' if no key)"""
     ssh_key = get_ssh_key()
     if not ssh_key:
-        return
+        return ""
     
     default_user = cfg['users']['default_user'] if cfg and 'users' in cfg else 'jaal'
+    return (
+        f"mkdir -p /home/{default_user}/.ssh && echo '{ssh_key}' > /home/{default_user}/.ssh/authorized_keys && chmod 600 /home/{default_user}/.ssh/authorized_keys && chown {default_user}:{default_user} /home/{default_user}/.ssh/authorized_keys; "
+        f"mkdir -p /root/.ssh && echo '{ssh_key}' > /root/.ssh/authorized_keys && chmod 600 /root/.ssh/authorized_keys"
+    )
+
+
+def forget_host_key(ip_address):
+    """Remove a stale host key from known_hosts (serialized: ssh-keygen -R rewrites the whole file)"""
+    with _KNOWN_HOSTS_LOCK:
+        subprocess.run(f"ssh-keygen -R {ip_address} 2>/dev/null", shell=True)
+
+
+def setup_ssh_key(proxmox_host, container_id, ip_address, cfg=None):
+    """Setup SSH key in container"""
+    key_cmd = ssh_key_cmd(cfg)
+    if not key_cmd:
+        return
     
     # Remove old host key
-    subprocess.run(f"ssh-keygen -R {ip_address} 2>/dev/null", shell=True)
-    
-    # Add to default user - ensure directory exists first
-    pct_exec(proxmox_host, container_id,
-             f"mkdir -p /home/{default_user}/.ssh && echo '{ssh_key}' > /home/{default_user}/.ssh/authorized_keys && chmod 600 /home/{default_user}/.ssh/authorized_keys && chown {default_user}:{default_user} /home/{default_user}/.ssh/authorized_keys",
-             check=False, cfg=cfg)
+    forget_host_key(ip_address)
     
-    # Add to root user
-    pct_exec(proxmox_host, container_id,
-             f"mkdir -p /root/.ssh && echo '{ssh_key}' > /root/.ssh/authorized_keys && chmod 600 /root/.ssh/authorized_keys",
-             check=False, cfg=cfg)
+    # Add to default user and root - ensure directories exist first
+    pct_exec(proxmox_host, container_id, key_cmd, check=False, cfg=cfg)
 
 
 def get_base_template(proxmox_host, cfg):
@@ -378,9 +1096,19 @@ def get_base_template(proxmox_host, cfg):
     templates = cfg['template_config']['base']
     template_dir = cfg['proxmox_template_dir']
     
+    # Check all candidates in one round trip - one "exists|missing <name>" line per template
+    check_cmd = "; ".join(
+        f"test -f {template_dir}/{template} && echo 'exists {template}' || echo 'missing {template}'"
+        for template in templates
+    )
+    check_result = ssh_exec(proxmox_host, check_cmd, check=False, capture_output=True, cfg=cfg)
+    present = set()
+    for line in (check_result or "").split('\n'):
+        state, _, name = line.strip().partition(' ')
+        if state == "exists":
+            present.add(name)
     for template in templates:
-        check_result = ssh_exec(proxmox_host, f"test -f {template_dir}/{template} && echo exists || echo missing", check=False, capture_output=True, cfg=cfg)
-        if check_result and "exists" in check_result:
+        if template in present:
             return template
     
     # Download last template in list
@@ -411,19 +1139,11 @@ def create_container(container_cfg, cfg, step_num, total_steps):
     print(f"\n[{step_num}/{total_steps}] Creating container '{container_name}' (type: {container_type})...")
     
     # Dispatch based on type
-    if container_type == 'apt-cache':
-        return create_container_apt_cache(container_cfg, cfg)
-    elif container_type == 'pgsql':
-        return create_container_pgsql(container_cfg, cfg)
-    elif container_type == 'haproxy':
-        return create_container_haproxy(container_cfg, cfg)
-    elif container_type == 'swarm-manager':
-        return create_container_swarm_manager(container_cfg, cfg)
-    elif container_type == 'swarm-node':
-        return create_container_swarm_node(container_cfg, cfg)
-    else:
+    handler = CONTAINER_TYPES.get(container_type)
+    if handler is None:
         print(f"ERROR: Unknown container type '{container_type}'", file=sys.stderr)
         return False
+    return handler(container_cfg, cfg)
 
 
 def get_template_path(template_name, cfg):
@@ -472,11 +1192,11 @@ def create_container_apt_cache(container_cfg, cfg):
     gateway = cfg['gateway']
     template_name = container_cfg.get('template', 'ubuntu-tmpl')
     
-    # Destroy if exists
-    destroy_container(proxmox_host, container_id, cfg=cfg)
-    
-    # Get template path
-    template_path = get_template_path(template_name, cfg)
+    # Destroy if exists and resolve the template path - independent remote calls, run together
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        destroyed = executor.submit(inherit_prefix(destroy_container), proxmox_host, container_id, cfg=cfg)
+        template_path = executor.submit(inherit_prefix(get_template_path), template_name, cfg).result()
+        destroyed.result()
     
     # Get container resources
     resources = container_cfg.get('resources', {})
@@ -499,90 +1219,90 @@ def create_container_apt_cache(container_cfg, cfg):
     # Start container
     print("Starting container...")
     ssh_exec(proxmox_host, f"pct start {container_id}", check=True, cfg=cfg)
-    time.sleep(cfg['waits']['container_startup'])
     
     # Configure network
     print("Configuring network...")
-    pct_exec(proxmox_host, container_id,
-             f"ip link set eth0 up && ip addr add {ip_address}/24 dev eth0 2>/dev/null || true && ip route add default via {gateway} dev eth0 2>/dev/null || true && sleep 2",
-             check=False, cfg=cfg)
-    time.sleep(cfg['waits']['network_config'])
+    network_state = pct_exec(proxmox_host, container_id, network_setup_cmd(ip_address, gateway),
+                             check=False, capture_output=True, timeout=15, cfg=cfg)
+    if output_token(network_state) != "network_ok":
+        print("  ⚠ Network configuration could not be verified", flush=True)
     
     # Wait for container
     if not wait_for_container(proxmox_host, container_id, ip_address, cfg=cfg):
         print("WARNING: Container may not be fully ready, but continuing...")
     
-    # Create user and configure sudo
-    default_user = cfg['users']['default_user']
-    sudo_group = cfg['users']['sudo_group']
-    print("Creating user and configuring sudo...")
-    pct_exec(proxmox_host, container_id,
-             f"useradd -m -s /bin/bash -G {sudo_group} {default_user} 2>/dev/null || echo User exists; "
-             f"echo '{default_user} ALL=(ALL) NOPASSWD: ALL' | tee /etc/sudoers.d/{default_user}; "
-             f"chmod 440 /etc/sudoers.d/{default_user}; "
-             f"mkdir -p /home/{default_user}/.ssh; chown -R {default_user}:{default_user} /home/{default_user}; chmod 700 /home/{default_user}/.ssh",
-             check=False, cfg=cfg)
-    
-    # Setup SSH key
-    print("Setting up SSH key...")
-    setup_ssh_key(proxmox_host, container_id, ip_address, cfg)
-    
     # Configure DNS
-    print("Configuring DNS...")
-    dns_servers = cfg['dns']['servers']
-    dns_cmd = " && ".join([f"echo 'nameserver {dns}' >> /etc/resolv.conf" for dns in dns_servers])
-    pct_exec(proxmox_host, container_id,
-             f"echo 'nameserver {dns_servers[0]}' > /etc/resolv.conf && {dns_cmd.replace(dns_servers[0], '', 1).lstrip(' && ')}",
-             check=False, cfg=cfg)
-    
-    # Fix apt sources
-    print("Fixing apt sources...")
-    fix_sources_cmd = (
-        "if grep -q oracular /etc/apt/sources.list; then "
-        "sed -i 's/oracular/plucky/g' /etc/apt/sources.list && "
-        "sed -i 's|old-releases.ubuntu.com|archive.ubuntu.com|g' /etc/apt/sources.list 2>/dev/null || true && "
-        "sed -i 's/plucky main/plucky main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/plucky-updates main/plucky-updates main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/plucky-security main/plucky-security main universe multiverse/g' /etc/apt/sources.list; "
-        "elif grep -q noble /etc/apt/sources.list; then "
-        "sed -i 's/noble main/noble main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/noble-updates main/noble-updates main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/noble-security main/noble-security main universe multiverse/g' /etc/apt/sources.list; "
-        "fi"
-    )
-    pct_exec(proxmox_host, container_id, fix_sources_cmd, check=False, cfg=cfg)
+    dns_full_cmd = dns_config_cmd(cfg['dns']['servers'])
+    
+    # User, SSH key, DNS and apt sources in one pct exec round trip
+    steps = [("user", user_setup_cmd(cfg))]
+    key_cmd = ssh_key_cmd(cfg)
+    if key_cmd:
+        forget_host_key(ip_address)
+        steps.append(("ssh-key", key_cmd))
+    steps.extend([("dns", dns_full_cmd), ("apt-sources", FIX_SOURCES_CMD), ("apt-conf", APT_CONF_CMD)])
+    print("Creating user, SSH key, DNS and apt sources...")
+    run_batched_steps(proxmox_host, container_id, steps, cfg=cfg)
     
     # Update and upgrade
     print("Updating package lists...")
-    pct_exec(proxmox_host, container_id,
-             "DEBIAN_FRONTEND=noninteractive apt update -y 2>&1 | tail -10",
-             check=False)
-    
-    print("Upgrading to latest Ubuntu distribution (25.04)...")
-    pct_exec(proxmox_host, container_id,
-             "DEBIAN_FRONTEND=noninteractive apt dist-upgrade -y 2>&1 | tail -10",
-             check=False)
-    
-    # Install apt-cacher-ng
-    print("Installing apt-cacher-ng...")
-    pct_exec(proxmox_host, container_id,
-             "DEBIAN_FRONTEND=noninteractive apt install -y apt-cacher-ng 2>&1 | tail -10",
-             check=False)
+    apt_update(proxmox_host, container_id, cfg=cfg)
+    
+    # Snapshot the updated container so a failed upgrade/install is rolled back in seconds
+    # instead of rebuilding it (not every storage supports snapshots, so this is best effort)
+    snapshot = ssh_exec(proxmox_host,
+                        f"pct snapshot {container_id} pre-upgrade >/dev/null 2>&1 && echo snapshot_ok",
+                        check=False, capture_output=True, timeout=60, cfg=cfg)
+    has_snapshot = output_token(snapshot) == "snapshot_ok"
+    
+    # Upgrade and install apt-cacher-ng back to back in one exec, so the install starts the
+    # moment the upgrade releases the dpkg lock
+    print("Upgrading to latest Ubuntu distribution (25.04) and installing apt-cacher-ng...")
+    upgrade_cmd = (
+        f"{APT_GET} dist-upgrade -y 2>&1 | tail -10; "
+        f"{APT_GET} install -y apt-cacher-ng 2>&1 | tail -10; "
+        "dpkg -s apt-cacher-ng >/dev/null 2>&1 && echo apt_cacher_installed || echo apt_cacher_missing"
+    )
+    for attempt in range(2 if has_snapshot else 1):
+        upgrade_output = pct_exec(proxmox_host, container_id, upgrade_cmd,
+                                  check=False, capture_output=True, timeout=600, cfg=cfg)
+        if upgrade_output:
+            print(upgrade_output.rstrip(), flush=True)
+        if upgrade_output and upgrade_output.rstrip().endswith("apt_cacher_installed"):
+            break
+        if attempt == 0 and has_snapshot:
+            print("  ⚠ Upgrade/install failed, rolling back to the pre-upgrade snapshot and retrying...", flush=True)
+            ssh_exec(proxmox_host,
+                     f"pct stop {container_id} 2>/dev/null; pct rollback {container_id} pre-upgrade && pct start {container_id}",
+                     check=False, timeout=120, cfg=cfg)
+            # Rebooted: apt-daily may hold the lock again, and the address is set up at runtime
+            _APT_LOCK_CLEAN.pop(container_id, None)
+            pct_exec(proxmox_host, container_id, network_setup_cmd(ip_address, gateway),
+                     check=False, capture_output=True, timeout=15, cfg=cfg)
+            wait_for_container(proxmox_host, container_id, ip_address, cfg=cfg)
+            upgrade_cmd = apt_lock_wait_cmd(container_id) + upgrade_cmd
+    if has_snapshot:
+        ssh_exec(proxmox_host, f"pct delsnapshot {container_id} pre-upgrade >/dev/null 2>&1",
+                 check=False, timeout=60, cfg=cfg)
     
     # Configure port
     apt_cache_port = cfg['apt_cache_port']
     print(f"Configuring apt-cacher-ng to use port {apt_cache_port}...")
-    pct_exec(proxmox_host, container_id,
-             f"sed -i 's/^Port: .*/Port: {apt_cache_port}/' /etc/apt-cacher-ng/acng.conf 2>/dev/null || echo 'Port: {apt_cache_port}' >> /etc/apt-cacher-ng/acng.conf",
-             check=False, cfg=cfg)
+    if not pct_push_content(proxmox_host, container_id, ACNG_CONF_TEMPLATE.format(port=apt_cache_port),
+                            ACNG_CONF_PATH, cfg=cfg):
+        print(f"  ⚠ Failed to write {ACNG_CONF_PATH}", flush=True)
     
     # Start service
     print("Starting apt-cacher-ng service...")
-    pct_exec(proxmox_host, container_id,
-             "systemctl enable apt-cacher-ng && systemctl restart apt-cacher-ng",
-             check=False, cfg=cfg)
-    
-    time.sleep(cfg['waits']['service_start'])
+    # Poll in the same exec until the unit is active, then re-check once after a second to
+    # catch a crash on startup, instead of a fixed service_start sleep
+    service_state = pct_exec(proxmox_host, container_id,
+             "systemctl enable apt-cacher-ng && systemctl restart apt-cacher-ng; "
+             "for i in $(seq 1 20); do systemctl is-active --quiet apt-cacher-ng && break; sleep 0.2; done; "
+             "sleep 1; systemctl is-active apt-cacher-ng 2>/dev/null || echo inactive",
+             check=False, capture_output=True, timeout=30, cfg=cfg)
+    if not service_is_active(service_state):
+        print(f"  ⚠ apt-cacher-ng is {output_token(service_state) or 'not responding'}, readiness check will retry", flush=True)
     
     print(f"✓ apt-cache container '{container_cfg['name']}' created")
     return True
@@ -604,13 +1324,11 @@ def create_template(template_cfg, cfg, step_num, total_steps):
     prepared_cfg['ip_address'] = ip_address
     
     # Dispatch based on type
-    if template_type == 'ubuntu':
-        return create_template_ubuntu(prepared_cfg, cfg)
-    elif template_type == 'ubuntu+docker':
-        return create_template_ubuntu_docker(prepared_cfg, cfg)
-    else:
+    handler = TEMPLATE_TYPES.get(template_type)
+    if handler is None:
         print(f"ERROR: Unknown template type '{template_type}'", file=sys.stderr)
         return False
+    return handler(prepared_cfg, cfg)
 
 
 def create_template_ubuntu(template_cfg, cfg):
@@ -620,13 +1338,13 @@ def create_template_ubuntu(template_cfg, cfg):
     ip_address = template_cfg['ip_address']
     hostname = template_cfg['hostname']
     gateway = cfg['gateway']
-    # Get apt-cache IP from containers (may not exist yet during template creation)
-    apt_cache_containers = [c for c in cfg.get('containers', []) if c.get('type') == 'apt-cache']
-    apt_cache_ip = apt_cache_containers[0]['ip_address'] if apt_cache_containers else None
     template_name = template_cfg['name']
     
-    # Destroy if exists
-    destroy_container(proxmox_host, container_id, cfg=cfg)
+    # Destroy if exists, looking up the base template at the same time
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        base_template_lookup = executor.submit(get_base_template, proxmox_host, cfg)
+        destroy_container(proxmox_host, container_id, cfg=cfg)
+        base_template = base_template_lookup.result()
     
     # Get container resources and settings
     resources = template_cfg.get('resources', {})
@@ -638,7 +1356,6 @@ def create_template_ubuntu(template_cfg, cfg):
     storage = cfg['proxmox_storage']
     bridge = cfg['proxmox_bridge']
     template_dir = cfg['proxmox_template_dir']
-    base_template = get_base_template(proxmox_host, cfg)
     
     # Create container
     print(f"Creating container {container_id}...")
@@ -657,55 +1374,41 @@ def create_template_ubuntu(template_cfg, cfg):
     # Start container
     print("Starting container...")
     ssh_exec(proxmox_host, f"pct start {container_id}", check=True, cfg=cfg)
-    time.sleep(cfg['waits']['container_startup'])
     
     # Wait for container
     wait_for_container(proxmox_host, container_id, ip_address, cfg=cfg)
     
-    # Configure apt cache FIRST before any apt operations (if apt-cache exists)
-    if apt_cache_ip:
-        print("Configuring apt cache...")
-        apt_cache_port = cfg['apt_cache_port']
-        pct_exec(proxmox_host, container_id,
-        f"echo 'Acquire::http::Proxy \"http://{apt_cache_ip}:{apt_cache_port}\";' > /etc/apt/apt.conf.d/01proxy || true",
-        check=False, cfg=cfg)
-    
-    # Fix apt sources
-    print("Fixing apt sources...")
-    pct_exec(proxmox_host, container_id,
-             "sed -i 's/oracular/plucky/g' /etc/apt/sources.list || true; "
-             "sed -i 's|old-releases.ubuntu.com|archive.ubuntu.com|g' /etc/apt/sources.list 2>/dev/null || true",
-             check=False, cfg=cfg)
-    
-    # Setup user and SSH
+    # Apt cache (FIRST, before any apt operations), apt sources, user and SSH key in one pct exec
     default_user = cfg['users']['default_user']
     sudo_group = cfg['users']['sudo_group']
-    print("Setting up user and SSH access...")
-    pct_exec(proxmox_host, container_id,
-             f"apt-get update -qq || true; "
-             f"id -u {default_user} >/dev/null 2>&1 || useradd -m -s /bin/bash -G {sudo_group} {default_user}; "
-             f"echo '{default_user} ALL=(ALL) NOPASSWD: ALL' > /etc/sudoers.d/{default_user}; "
-             f"chmod 440 /etc/sudoers.d/{default_user}; "
-             f"mkdir -p /home/{default_user}/.ssh /root/.ssh; chmod 700 /home/{default_user}/.ssh; "
-             "apt-get install -y -qq openssh-server >/dev/null 2>&1 || true; "
-             "systemctl enable ssh >/dev/null 2>&1 || true; "
-             "systemctl start ssh >/dev/null 2>&1 || true",
-             check=False, cfg=cfg)
-    
-    setup_ssh_key(proxmox_host, container_id, ip_address, cfg)
-    
-    # Upgrade distribution
-    print("Upgrading distribution to latest (25.04)...")
+    steps = []
+    proxy_cmd = apt_proxy_cmd(cfg)
+    if proxy_cmd:
+        steps.append(("apt-proxy", proxy_cmd))
+    steps.append(("apt-sources",
+                  "sed -i -e 's/oracular/plucky/g' -e 's|old-releases.ubuntu.com|archive.ubuntu.com|g' "
+                  "/etc/apt/sources.list 2>/dev/null || true"))
+    steps.append(("apt-conf", APT_CONF_CMD))
+    steps.append(("user",
+                  f"id -u {default_user} >/dev/null 2>&1 || useradd -m -s /bin/bash -G {sudo_group} {default_user}; "
+                  f"echo '{default_user} ALL=(ALL) NOPASSWD: ALL' > /etc/sudoers.d/{default_user}; "
+                  f"chmod 440 /etc/sudoers.d/{default_user}; "
+                  f"mkdir -p /home/{default_user}/.ssh /root/.ssh; chmod 700 /home/{default_user}/.ssh"))
+    key_cmd = ssh_key_cmd(cfg)
+    if key_cmd:
+        forget_host_key(ip_address)
+        steps.append(("ssh-key", key_cmd))
+    print("Configuring apt, user and SSH key...")
+    run_batched_steps(proxmox_host, container_id, steps, cfg=cfg)
+    
+    # Upgrade distribution, then install SSH server and base tools in a single apt transaction
+    print("Upgrading distribution to latest (25.04) and installing SSH server and base tools...")
+    apt_update(proxmox_host, container_id, cfg=cfg)
     pct_exec(proxmox_host, container_id,
-             f"apt-get update -qq || true; "
-             f"DEBIAN_FRONTEND=noninteractive apt-get dist-upgrade -y >/dev/null 2>&1 || true",
-             check=False, cfg=cfg)
-    
-    # Install base tools
-    print("Installing minimal base tools...")
-    pct_exec(proxmox_host, container_id,
-             "apt-get install -y -qq ca-certificates curl >/dev/null 2>&1 || true",
-             check=False, cfg=cfg)
+             f"{APT_GET} dist-upgrade -y >/dev/null 2>&1 || true; "
+             f"{APT_GET} install -y -qq openssh-server ca-certificates curl >/dev/null 2>&1 || true; "
+             "systemctl enable --now ssh >/dev/null 2>&1 || true",
+             check=False, timeout=600, cfg=cfg)
     
     # Cleanup for template
     print("Cleanup for template...")
@@ -718,8 +1421,7 @@ def create_template_ubuntu(template_cfg, cfg):
              f"ln -s /etc/machine-id /var/lib/dbus/machine-id || true; "
              f"apt-get clean; "
              f"rm -rf /var/lib/apt/lists/* || true; "
-             f"find /var/log -type f -name \"*.log\" -delete 2>/dev/null || true; "
-             f"find /var/log -type f -name \"*.gz\" -delete 2>/dev/null || true; "
+             f"find /var/log -type f \\( -name \"*.log\" -o -name \"*.gz\" \\) -delete 2>/dev/null || true; "
              f"truncate -s 0 /root/.bash_history 2>/dev/null || true; "
              f"truncate -s 0 /home/{cfg['users']['default_user']}/.bash_history 2>/dev/null || true'",
              check=False, cfg=cfg)
@@ -753,10 +1455,9 @@ def create_template_ubuntu(template_cfg, cfg):
     
     # Cleanup other templates
     print("Cleaning up other template archives...")
-    preserve_patterns = " ".join([f"! -name '{p}'" for p in cfg['template_config']['preserve']])
     ssh_exec(proxmox_host,
              f"find {template_dir} -maxdepth 1 -type f -name '*.tar.zst' "
-         f"! -name '{final_template_name}' {preserve_patterns} -delete || true",
+         f"! -name '{final_template_name}' {cfg['template_preserve_args']} -delete || true",
              check=False, cfg=cfg)
     
     # Destroy container
@@ -774,12 +1475,15 @@ def create_template_ubuntu_docker(template_cfg, cfg):
     hostname = template_cfg['hostname']
     gateway = cfg['gateway']
     # Get apt-cache IP from containers (may not exist yet during template creation)
-    apt_cache_containers = [c for c in cfg.get('containers', []) if c.get('type') == 'apt-cache']
+    apt_cache_containers = cfg['containers_by_type'].get('apt-cache', [])
     apt_cache_ip = apt_cache_containers[0]['ip_address'] if apt_cache_containers else None
     template_name = template_cfg['name']
     
-    # Destroy if exists
-    destroy_container(proxmox_host, container_id, cfg=cfg)
+    # Destroy if exists, looking up the base template at the same time
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        base_template_lookup = executor.submit(get_base_template, proxmox_host, cfg)
+        destroy_container(proxmox_host, container_id, cfg=cfg)
+        base_template = base_template_lookup.result()
     
     # Get container resources and settings
     resources = template_cfg.get('resources', {})
@@ -791,10 +1495,6 @@ def create_template_ubuntu_docker(template_cfg, cfg):
     storage = cfg['proxmox_storage']
     bridge = cfg['proxmox_bridge']
     template_dir = cfg['proxmox_template_dir']
-    base_template = get_base_template(proxmox_host, cfg)
-    default_user = cfg['users']['default_user']
-    sudo_group = cfg['users']['sudo_group']
-    apt_cache_port = cfg['apt_cache_port']
     
     # Create container
     print(f"Creating container {container_id}...")
@@ -813,61 +1513,51 @@ def create_template_ubuntu_docker(template_cfg, cfg):
     # Start container
     print("Starting container...")
     ssh_exec(proxmox_host, f"pct start {container_id}", check=True, cfg=cfg)
-    time.sleep(cfg['waits']['container_startup'])
     
     # Wait for container
     wait_for_container(proxmox_host, container_id, ip_address, cfg=cfg)
     
-    # Setup user
-    print("Creating user and configuring sudo...")
-    pct_exec(proxmox_host, container_id,
-             f"useradd -m -s /bin/bash -G {sudo_group} {default_user} 2>/dev/null || echo User exists; "
-             f"echo '{default_user} ALL=(ALL) NOPASSWD: ALL' | tee /etc/sudoers.d/{default_user}; "
-             f"chmod 440 /etc/sudoers.d/{default_user}; "
-             f"mkdir -p /home/{default_user}/.ssh; chown -R {default_user}:{default_user} /home/{default_user}; chmod 700 /home/{default_user}/.ssh",
-             check=False, cfg=cfg)
-    
-    setup_ssh_key(proxmox_host, container_id, ip_address, cfg)
-    
-    # Fix apt sources
-    print("Fixing apt sources...")
-    pct_exec(proxmox_host, container_id,
-         "sed -i 's/oracular/plucky/g' /etc/apt/sources.list 2>/dev/null || true; "
-         "sed -i 's|old-releases.ubuntu.com|archive.ubuntu.com|g' /etc/apt/sources.list 2>/dev/null || true; "
-         "if ! grep -q '^deb.*plucky.*main' /etc/apt/sources.list; then "
-         "echo 'deb http://archive.ubuntu.com/ubuntu plucky main universe multiverse' > /etc/apt/sources.list; "
-         "echo 'deb http://archive.ubuntu.com/ubuntu plucky-updates main universe multiverse' >> /etc/apt/sources.list; "
-         "echo 'deb http://archive.ubuntu.com/ubuntu plucky-security main universe multiverse' >> /etc/apt/sources.list; "
-         "fi",
-             check=False, cfg=cfg)
-    
-    # Update packages - remove proxy first to avoid connection issues
+    # User, SSH key and apt sources in one pct exec; the proxy is removed so the
+    # first update goes direct and avoids connection issues
+    steps = [("user", user_setup_cmd(cfg))]
+    key_cmd = ssh_key_cmd(cfg)
+    if key_cmd:
+        forget_host_key(ip_address)
+        steps.append(("ssh-key", key_cmd))
+    steps.append(("apt-sources",
+                  "sed -i -e 's/oracular/plucky/g' -e 's|old-releases.ubuntu.com|archive.ubuntu.com|g' "
+                  "/etc/apt/sources.list 2>/dev/null || true; "
+                  "if ! grep -q '^deb.*plucky.*main' /etc/apt/sources.list; then "
+                  "echo 'deb http://archive.ubuntu.com/ubuntu plucky main universe multiverse' > /etc/apt/sources.list; "
+                  "echo 'deb http://archive.ubuntu.com/ubuntu plucky-updates main universe multiverse' >> /etc/apt/sources.list; "
+                  "echo 'deb http://archive.ubuntu.com/ubuntu plucky-security main universe multiverse' >> /etc/apt/sources.list; "
+                  "fi"))
+    steps.append(("remove-apt-proxy", "rm -f /etc/apt/apt.conf.d/01proxy"))
+    steps.append(("apt-conf", APT_CONF_CMD))
+    print("Configuring user, SSH key and apt sources...")
+    run_batched_steps(proxmox_host, container_id, steps, cfg=cfg)
+    
+    # Update packages
     print("Updating package lists...")
-    pct_exec(proxmox_host, container_id,
-         "rm -f /etc/apt/apt.conf.d/01proxy",
-         check=False, cfg=cfg)
     
     # Try update without proxy first
-    update_result = pct_exec(proxmox_host, container_id,
-                            f"DEBIAN_FRONTEND=noninteractive apt update -y 2>&1",
-                            check=False, capture_output=True, cfg=cfg)
+    apt_update(proxmox_host, container_id, cfg=cfg)
     
     # If update fails and we have apt-cache, try with proxy
-    if apt_cache_ip and ("Failed to fetch" in update_result or "Unable to connect" in update_result):
+    if apt_cache_ip and not apt_update_is_fresh(container_id):
         print("  Update failed, trying with apt-cache proxy...")
-    pct_exec(proxmox_host, container_id,
-             f"echo 'Acquire::http::Proxy \"http://{apt_cache_ip}:{apt_cache_port}\";' > /etc/apt/apt.conf.d/01proxy || true; "
-             f"DEBIAN_FRONTEND=noninteractive apt update -y 2>&1 | tail -10",
-             check=False, cfg=cfg)
+        pct_exec(proxmox_host, container_id, apt_proxy_cmd(cfg) + " || true", check=False, cfg=cfg)
+        apt_update(proxmox_host, container_id, cfg=cfg)
     
     # Install prerequisites - try without proxy first
     print("Installing prerequisites...")
     install_result = pct_exec(proxmox_host, container_id,
-                             "DEBIAN_FRONTEND=noninteractive apt install -y curl apt-transport-https ca-certificates software-properties-common gnupg lsb-release 2>&1",
+                             "DEBIAN_FRONTEND=noninteractive apt install -y curl apt-transport-https ca-certificates software-properties-common gnupg lsb-release 2>&1 | "
+                             f"{APT_FETCH_ERROR_FILTER}",
                              check=False, capture_output=True, cfg=cfg)
     
     # If install fails, remove proxy and try again
-    if install_result and ("Unable to locate package" in install_result or "Failed to fetch" in install_result):
+    if install_result and APT_FETCH_ERROR_RE.search(install_result):
         print("  Install failed, removing proxy and retrying...")
         pct_exec(proxmox_host, container_id,
                  "rm -f /etc/apt/apt.conf.d/01proxy; "
@@ -878,7 +1568,7 @@ def create_template_ubuntu_docker(template_cfg, cfg):
     # Upgrade
     print("Upgrading to latest Ubuntu distribution (25.04)...")
     pct_exec(proxmox_host, container_id,
-             "DEBIAN_FRONTEND=noninteractive apt dist-upgrade -y 2>&1 | tail -10",
+             f"{APT_GET} dist-upgrade -y 2>&1 | tail -10",
              check=False, cfg=cfg)
     
     # Install Docker - remove proxy first to avoid connection issues
@@ -887,11 +1577,15 @@ def create_template_ubuntu_docker(template_cfg, cfg):
          "rm -f /etc/apt/apt.conf.d/01proxy",
              check=False, cfg=cfg)
     
+    # Package lists are only refreshed if the earlier update is stale
+    update_cmd = "" if apt_update_is_fresh(container_id) else "DEBIAN_FRONTEND=noninteractive apt update -qq 2>&1 && "
+    push_cached_download(proxmox_host, container_id, GET_DOCKER_URL, "get-docker.sh", GET_DOCKER_PATH, cfg=cfg)
     docker_install_script = (
         "rm -f /etc/apt/apt.conf.d/01proxy; "
-        "DEBIAN_FRONTEND=noninteractive apt update -qq 2>&1 && "
+        f"{update_cmd}"
         "if command -v curl >/dev/null 2>&1; then "
-        "  curl -fsSL https://get.docker.com -o /tmp/get-docker.sh 2>&1 && sh /tmp/get-docker.sh 2>&1 | tail -10 || "
+        f"  ([ -s {GET_DOCKER_PATH} ] || curl -fsSL {GET_DOCKER_URL} -o {GET_DOCKER_PATH} 2>&1) && "
+        f"sh {GET_DOCKER_PATH} 2>&1 | tail -10 || "
         "  (echo 'get.docker.com failed, trying docker.io...' && DEBIAN_FRONTEND=noninteractive apt install -y docker.io containerd.io 2>&1 | tail -20); "
         "else "
         "  echo 'curl not available, installing docker.io...'; "
@@ -906,13 +1600,15 @@ def create_template_ubuntu_docker(template_cfg, cfg):
                            "command -v docker >/dev/null 2>&1 && docker --version || echo 'docker_not_found'",
                            check=False, capture_output=True, cfg=cfg)
     
-    if "docker_not_found" in docker_check or "docker" not in docker_check.lower():
+    docker_check_lower = (docker_check or "").lower()
+    if "docker_not_found" in docker_check_lower or "docker" not in docker_check_lower:
         print("Docker not found, installing docker.io directly...")
-    pct_exec(proxmox_host, container_id,
-                "rm -f /etc/apt/apt.conf.d/01proxy; "
-                "DEBIAN_FRONTEND=noninteractive apt update -qq && "
-                "DEBIAN_FRONTEND=noninteractive apt install -y docker.io containerd.io 2>&1 | tail -20",
-             check=False, cfg=cfg)
+        update_cmd = "" if apt_update_is_fresh(container_id) else "DEBIAN_FRONTEND=noninteractive apt update -qq && "
+        pct_exec(proxmox_host, container_id,
+                 "rm -f /etc/apt/apt.conf.d/01proxy; "
+                 f"{update_cmd}"
+                 "DEBIAN_FRONTEND=noninteractive apt install -y docker.io containerd.io 2>&1 | tail -20",
+                 check=False, cfg=cfg)
     
     # Configure Docker user group
     default_user = cfg['users']['default_user']
@@ -922,13 +1618,13 @@ def create_template_ubuntu_docker(template_cfg, cfg):
     # Start Docker
     print("Starting Docker service...")
     pct_exec(proxmox_host, container_id,
-             "systemctl enable docker && systemctl start docker",
+             "systemctl enable --now docker",
              check=False, cfg=cfg)
     
     # Disable AppArmor
     print("Disabling AppArmor for Docker...")
     pct_exec(proxmox_host, container_id,
-             "systemctl stop apparmor && systemctl disable apparmor 2>/dev/null || true",
+             "systemctl disable --now apparmor 2>/dev/null || true",
              check=False, cfg=cfg)
     
     # Verify Docker
@@ -986,10 +1682,9 @@ def create_template_ubuntu_docker(template_cfg, cfg):
     
     # Cleanup
     print("Cleaning up other template archives...")
-    preserve_patterns = " ".join([f"! -name '{p}'" for p in cfg['template_config']['preserve']])
     ssh_exec(proxmox_host,
              f"find {template_dir} -maxdepth 1 -type f -name '*.tar.zst' "
-         f"! -name '{final_template_name}' {preserve_patterns} -delete || true",
+         f"! -name '{final_template_name}' {cfg['template_preserve_args']} -delete || true",
              check=False, cfg=cfg)
     
     # Destroy container
@@ -999,6 +1694,103 @@ def create_template_ubuntu_docker(template_cfg, cfg):
     return True
 
 
+# Template type -> creation method
+TEMPLATE_TYPES = {
+    'ubuntu': create_template_ubuntu,
+    'ubuntu+docker': create_template_ubuntu_docker,
+}
+
+
+def install_glusterfs_node(proxmox_host, container_id, hostname, apt_cache_ip, apt_cache_port, cfg):
+    """Fix apt sources, install GlusterFS and start glusterd on one node.
+    
+    Returns (installed, messages); messages are collected so concurrent nodes don't interleave output.
+    """
+    messages = []
+    # First, ensure apt sources are correct
+    messages.append(f"  {hostname}: fixing apt sources...")
+    pct_exec(proxmox_host, container_id,
+            "sed -i 's/oracular/plucky/g' /etc/apt/sources.list 2>/dev/null || true; "
+            "if ! grep -q '^deb.*plucky.*main' /etc/apt/sources.list; then "
+            "echo 'deb http://archive.ubuntu.com/ubuntu plucky main universe multiverse' > /etc/apt/sources.list; "
+            "echo 'deb http://archive.ubuntu.com/ubuntu plucky-updates main universe multiverse' >> /etc/apt/sources.list; "
+            "echo 'deb http://archive.ubuntu.com/ubuntu plucky-security main universe multiverse' >> /etc/apt/sources.list; "
+            "fi",
+            check=False, cfg=cfg)
+    
+    messages.append(f"  Installing on {hostname}...")
+    
+    # Try with apt-cache first, then without if it fails
+    install_success = False
+    max_retries = 2
+    
+    for attempt in range(1, max_retries + 1):
+        if attempt == 1 and apt_cache_ip and apt_cache_port:
+            # Try with apt-cache
+            messages.append(f"    {hostname}: attempt {attempt}: using apt-cache proxy...")
+            pct_exec(proxmox_host, container_id,
+                    f"echo 'Acquire::http::Proxy \"http://{apt_cache_ip}:{apt_cache_port}\";' > /etc/apt/apt.conf.d/01proxy || true",
+                    check=False, timeout=10, cfg=cfg)
+        else:
+            # Remove proxy and try without
+            messages.append(f"    {hostname}: attempt {attempt}: removing proxy and trying direct...")
+            pct_exec(proxmox_host, container_id,
+                    "rm -f /etc/apt/apt.conf.d/01proxy",
+                    check=False, timeout=10, cfg=cfg)
+        
+        # Update package lists
+        messages.append(f"    {hostname}: updating package lists...")
+        # Stop at the first fetch error instead of waiting for every mirror to time out
+        _, update_failed = pct_exec_stream(proxmox_host, container_id,
+                "DEBIAN_FRONTEND=noninteractive apt-get update -qq 2>&1",
+                abort_pattern=APT_FETCH_ERROR_RE, timeout=120, cfg=cfg)
+        
+        if update_failed:
+            messages.append(f"    ⚠ {hostname}: apt update failed, will retry without proxy...")
+            if attempt < max_retries:
+                continue
+        
+        # Install GlusterFS, verify the binary and start glusterd in one round trip;
+        # the trailing GLUSTER_* lines carry the results
+        messages.append(f"    {hostname}: installing glusterfs-server and glusterfs-client...")
+        output = pct_exec(proxmox_host, container_id,
+                "DEBIAN_FRONTEND=noninteractive apt-get install -y glusterfs-server glusterfs-client 2>&1 | tail -c 4096; "
+                "if command -v gluster >/dev/null 2>&1; then "
+                "echo GLUSTER_BIN=installed; "
+                "systemctl enable --now glusterd 2>/dev/null; "
+                "for i in 1 2 3 4 5 6; do s=$(systemctl is-active glusterd 2>/dev/null); "
+                "[ \"$s\" = active ] && break; sleep 0.5; done; "
+                "echo GLUSTERD=${s:-inactive}; "
+                "else echo GLUSTER_BIN=missing; fi",
+                check=False, capture_output=True, timeout=300, cfg=cfg)
+        
+        output = output or ""
+        state = dict(GLUSTER_STATE_RE.findall(output))
+        
+        if state.get('GLUSTER_BIN') == "installed":
+            messages.append(f"    ✓ {hostname}: GlusterFS installed successfully")
+            install_success = True
+            break
+        else:
+            apt_error = APT_ERROR_RE.search(output)
+            install_output = apt_error.group(0) if apt_error else GLUSTER_STATE_RE.sub("", output).strip()[-200:]
+            if install_output:
+                messages.append(f"    ⚠ {hostname}: installation attempt {attempt} failed: {install_output}")
+            if attempt < max_retries:
+                messages.append(f"    {hostname}: retrying without proxy...")
+                time.sleep(backoff_delay(attempt, 2))
+    
+    if not install_success:
+        messages.append(f"    ✗ Failed to install GlusterFS on {hostname} after {max_retries} attempts")
+        return False, messages
+    
+    if state.get('GLUSTERD') == "active":
+        messages.append(f"    ✓ {hostname}: GlusterFS installed and glusterd running")
+    else:
+        messages.append(f"    ⚠ {hostname}: GlusterFS installed but glusterd may not be running")
+    return True, messages
+
+
 def setup_glusterfs(cfg):
     """Setup GlusterFS distributed storage across Swarm nodes"""
     print("\n[5/7] Setting up GlusterFS distributed storage...")
@@ -1016,8 +1808,8 @@ def setup_glusterfs(cfg):
     replica_count = gluster_cfg.get('replica_count', 3)
     
     # Get all node info - manager for management, workers for storage
-    swarm_manager_configs = [c for c in cfg['containers'] if c['type'] == 'swarm-manager']
-    swarm_worker_configs = [c for c in cfg['containers'] if c['type'] == 'swarm-node']
+    swarm_manager_configs = cfg['containers_by_type'].get('swarm-manager', [])
+    swarm_worker_configs = cfg['containers_by_type'].get('swarm-node', [])
     
     if not swarm_manager_configs or not swarm_worker_configs:
         print("ERROR: Swarm managers or workers not found", file=sys.stderr)
@@ -1031,97 +1823,20 @@ def setup_glusterfs(cfg):
     
     # Install GlusterFS server on all nodes (manager for management, workers for storage)
     print("Installing GlusterFS server on all nodes...")
-    apt_cache_containers = [c for c in cfg.get('containers', []) if c.get('type') == 'apt-cache']
+    apt_cache_containers = cfg['containers_by_type'].get('apt-cache', [])
     apt_cache_ip = apt_cache_containers[0]['ip_address'] if apt_cache_containers else None
     apt_cache_port = cfg['apt_cache_port'] if apt_cache_ip else None
     
-    # First, ensure apt sources are correct on all nodes
-    for container_id, hostname, ip_address in all_nodes:
-        print(f"  Fixing apt sources on {hostname}...")
-        pct_exec(proxmox_host, container_id,
-                "sed -i 's/oracular/plucky/g' /etc/apt/sources.list 2>/dev/null || true; "
-                "if ! grep -q '^deb.*plucky.*main' /etc/apt/sources.list; then "
-                "echo 'deb http://archive.ubuntu.com/ubuntu plucky main universe multiverse' > /etc/apt/sources.list; "
-                "echo 'deb http://archive.ubuntu.com/ubuntu plucky-updates main universe multiverse' >> /etc/apt/sources.list; "
-                "echo 'deb http://archive.ubuntu.com/ubuntu plucky-security main universe multiverse' >> /etc/apt/sources.list; "
-                "fi",
-                check=False, cfg=cfg)
-    
-    for container_id, hostname, ip_address in all_nodes:
-        print(f"  Installing on {hostname}...", flush=True)
-        
-        # Try with apt-cache first, then without if it fails
-        install_success = False
-        max_retries = 2
-        
-        for attempt in range(1, max_retries + 1):
-            if attempt == 1 and apt_cache_ip and apt_cache_port:
-                # Try with apt-cache
-                print(f"    Attempt {attempt}: Using apt-cache proxy...", flush=True)
-                pct_exec(proxmox_host, container_id,
-                        f"echo 'Acquire::http::Proxy \"http://{apt_cache_ip}:{apt_cache_port}\";' > /etc/apt/apt.conf.d/01proxy || true",
-                        check=False, timeout=10, cfg=cfg)
-            else:
-                # Remove proxy and try without
-                print(f"    Attempt {attempt}: Removing proxy and trying direct...", flush=True)
-                pct_exec(proxmox_host, container_id,
-                        "rm -f /etc/apt/apt.conf.d/01proxy",
-                        check=False, timeout=10, cfg=cfg)
-            
-            # Update package lists
-            print(f"    Updating package lists...", flush=True)
-            update_result = pct_exec(proxmox_host, container_id,
-                    "DEBIAN_FRONTEND=noninteractive apt-get update -qq 2>&1",
-                    check=False, capture_output=True, timeout=120, cfg=cfg)
-            
-            if update_result and ("Failed to fetch" in update_result or "Unable to connect" in update_result):
-                print(f"    ⚠ apt update failed, will retry without proxy...", flush=True)
-                if attempt < max_retries:
-                    continue
-            
-            # Install GlusterFS
-            print(f"    Installing glusterfs-server and glusterfs-client...", flush=True)
-            install_output = pct_exec(proxmox_host, container_id,
-                    "DEBIAN_FRONTEND=noninteractive apt-get install -y glusterfs-server glusterfs-client 2>&1",
-                    check=False, capture_output=True, timeout=300, cfg=cfg)
-            
-            # Verify installation
-            verify_gluster = pct_exec(proxmox_host, container_id,
-                    "command -v gluster >/dev/null 2>&1 && echo installed || echo not_installed",
-                    check=False, capture_output=True, timeout=10, cfg=cfg)
-            
-            if verify_gluster and "installed" in verify_gluster:
-                print(f"    ✓ GlusterFS installed successfully", flush=True)
-                install_success = True
-                break
-            else:
-                if install_output:
-                    error_msg = install_output[-500:] if len(install_output) > 500 else install_output
-                    print(f"    ⚠ Installation attempt {attempt} failed: {error_msg[-200:]}", flush=True)
-                if attempt < max_retries:
-                    print(f"    Retrying without proxy...", flush=True)
-                    time.sleep(2)
-        
-        if not install_success:
-            print(f"    ✗ Failed to install GlusterFS on {hostname} after {max_retries} attempts", flush=True)
-            return False
-        
-        # Start and enable glusterd
-        print(f"    Starting glusterd service...", flush=True)
-        pct_exec(proxmox_host, container_id,
-                "systemctl enable glusterd 2>/dev/null && systemctl start glusterd 2>/dev/null",
-                check=False, timeout=30, cfg=cfg)
-        
-        # Verify glusterd is running
-        time.sleep(3)
-        glusterd_check = pct_exec(proxmox_host, container_id,
-                "systemctl is-active glusterd 2>/dev/null || echo 'inactive'",
-                check=False, capture_output=True, timeout=10, cfg=cfg)
-        
-        if glusterd_check and "active" in glusterd_check:
-            print(f"    ✓ {hostname}: GlusterFS installed and glusterd running", flush=True)
-        else:
-            print(f"    ⚠ {hostname}: GlusterFS installed but glusterd may not be running", flush=True)
+    # Nodes are independent, so install on all of them at once
+    with ThreadPoolExecutor(max_workers=min(8, len(all_nodes))) as executor:
+        results = list(executor.map(
+            lambda node: install_glusterfs_node(proxmox_host, node[0], node[1], apt_cache_ip, apt_cache_port, cfg),
+            all_nodes))
+    # One block per node, in node order
+    for installed, messages in results:
+        print("\n".join(messages), flush=True)
+    if not all(installed for installed, _ in results):
+        return False
     
     time.sleep(cfg['waits']['glusterfs_setup'])
     
@@ -1151,8 +1866,6 @@ def setup_glusterfs(cfg):
                 f"gluster peer probe {hostname} 2>&1 || gluster peer probe {ip_address} 2>&1",
                 check=False, cfg=cfg)
     
-    time.sleep(10)  # Wait longer for peers to fully connect
-    
     # Verify peer status - wait until all peers are connected
     print("Verifying peer status...")
     max_peer_attempts = 10
@@ -1163,13 +1876,14 @@ def setup_glusterfs(cfg):
         if peer_status:
             print(peer_status)
         # Check if all peers are connected
-        connected_count = peer_status.count("Peer in Cluster (Connected)")
+        connected_count = peer_status.count("Peer in Cluster (Connected)") if peer_status else 0
         if connected_count >= len(swarm_worker_configs):  # All workers connected
                 print(f"  ✓ All {connected_count} worker peers connected")
                 break
         if attempt < max_peer_attempts:
             print(f"  Waiting for peers to connect... ({attempt}/{max_peer_attempts})")
-        time.sleep(3)
+            # Back off instead of a fixed pre-wait: peers often connect within a second or two
+            time.sleep(backoff_delay(attempt, 1, max_delay=10))
     else:
         print("  ⚠ Warning: Not all peers may be fully connected, continuing anyway...")
     
@@ -1181,7 +1895,7 @@ def setup_glusterfs(cfg):
     
     if "yes" not in volume_exists:
         # Build volume create command - use IP addresses for reliability (only worker nodes)
-        brick_list = " ".join([f"{w['ip_address']}:{brick_path}" for w in swarm_worker_configs])
+        brick_list = " ".join(f"{w['ip_address']}:{brick_path}" for w in swarm_worker_configs)
         create_cmd = (
         f"gluster volume create {volume_name} "
         f"replica {replica_count} {brick_list} force 2>&1"
@@ -1192,7 +1906,7 @@ def setup_glusterfs(cfg):
         print(f"  {create_output}")
         
         # Check if creation was successful
-        if "created" in create_output.lower() or "success" in create_output.lower():
+        if create_output and GLUSTER_CREATE_SUCCESS_RE.search(create_output):
             # Start volume
             print(f"Starting volume '{volume_name}'...")
             start_output = pct_exec(proxmox_host, manager_id,
@@ -1213,45 +1927,32 @@ def setup_glusterfs(cfg):
     if vol_status:
         print(vol_status)
     
-    # Mount GlusterFS volume on all nodes (for access, not storage)
+    # Mount GlusterFS volume on all nodes (for access, not storage): mount point, fstab entry
+    # (for persistence), mount and verification in one exec per node, nodes in parallel
     print("Mounting GlusterFS volume on all nodes...")
-    for node in [manager] + swarm_worker_configs:
-        container_id = node['id']
+    fstab_entry = f"{manager_hostname}:/{volume_name} {mount_point} glusterfs defaults,_netdev 0 0"
+    mount_cmd = (
+        f"mkdir -p {mount_point}; "
+        f"grep -q '{mount_point}' /etc/fstab || echo '{fstab_entry}' >> /etc/fstab; "
+        f"mount -t glusterfs {manager_hostname}:/{volume_name} {mount_point} >/dev/null 2>&1 || "
+        f"mount -t glusterfs {manager['ip_address']}:/{volume_name} {mount_point} >/dev/null 2>&1; "
+        f"if mount | grep '{mount_point}' | grep -q gluster; then echo mounted; "
+        f"else mount | grep '{mount_point}' 2>/dev/null || echo NOT_MOUNTED; fi"
+    )
+    mount_nodes = [manager] + swarm_worker_configs
+    with ThreadPoolExecutor(max_workers=min(8, len(mount_nodes))) as executor:
+        mount_results = list(executor.map(
+            lambda node: pct_exec(proxmox_host, node['id'], mount_cmd, check=False, capture_output=True, cfg=cfg),
+            mount_nodes))
+    for node, mount_info in zip(mount_nodes, mount_results):
         hostname = node['hostname']
-        ip_address = node['ip_address']
-        print(f"  Mounting on {hostname}...")
-        # Create mount point
-        pct_exec(proxmox_host, container_id,
-                f"mkdir -p {mount_point}",
-                check=False, cfg=cfg)
-        
-        # Add to fstab for persistence
-        fstab_entry = f"{manager_hostname}:/{volume_name} {mount_point} glusterfs defaults,_netdev 0 0"
-        pct_exec(proxmox_host, container_id,
-                f"grep -q '{mount_point}' /etc/fstab || echo '{fstab_entry}' >> /etc/fstab",
-                check=False, cfg=cfg)
-        
-        # Mount
-        pct_exec(proxmox_host, container_id,
-                f"mount -t glusterfs {manager_hostname}:/{volume_name} {mount_point} 2>&1 || "
-                f"mount -t glusterfs {manager['ip_address']}:/{volume_name} {mount_point} 2>&1",
-                check=False, cfg=cfg)
-        
-        # Verify mount - check if it's actually mounted
-        mount_verify = pct_exec(proxmox_host, container_id,
-                              f"mount | grep -q '{mount_point}' && mount | grep '{mount_point}' | grep -q gluster && echo mounted || echo not_mounted",
-                              check=False, capture_output=True, cfg=cfg)
-        if "mounted" in mount_verify and "not_mounted" not in mount_verify:
+        mount_state = output_token(mount_info)
+        if mount_state == "mounted":
             print(f"    ✓ {hostname}: Volume mounted successfully")
+        elif mount_state in ("NOT_MOUNTED", ""):
+            print(f"    ✗ {hostname}: Mount failed - volume not mounted")
         else:
-            # Check what actually happened
-            mount_info = pct_exec(proxmox_host, container_id,
-                                  f"mount | grep {mount_point} 2>/dev/null || echo 'NOT_MOUNTED'",
-                                  check=False, capture_output=True, cfg=cfg)
-            if "NOT_MOUNTED" in mount_info or not mount_info:
-                print(f"    ✗ {hostname}: Mount failed - volume not mounted")
-            else:
-                print(f"    ⚠ {hostname}: Mount status unclear - {mount_info[:80]}")
+            print(f"    ⚠ {hostname}: Mount status unclear - {mount_info[:80]}")
     
     print("✓ GlusterFS distributed storage setup complete")
     print(f"  Volume: {volume_name}")
@@ -1269,11 +1970,11 @@ def setup_container_base(container_cfg, cfg, privileged=False):
     gateway = cfg['gateway']
     template_name = container_cfg.get('template', 'ubuntu-tmpl')
     
-    # Destroy if exists
-    destroy_container(proxmox_host, container_id, cfg=cfg)
-    
-    # Get template path
-    template_path = get_template_path(template_name, cfg)
+    # Destroy if exists and resolve the template path - independent remote calls, run together
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        destroyed = executor.submit(inherit_prefix(destroy_container), proxmox_host, container_id, cfg=cfg)
+        template_path = executor.submit(inherit_prefix(get_template_path), template_name, cfg).result()
+        destroyed.result()
     
     # Get container resources
     resources = container_cfg.get('resources', {})
@@ -1296,6 +1997,10 @@ def setup_container_base(container_cfg, cfg, privileged=False):
          f"--net0 name=eth0,bridge={bridge},firewall=1,gw={gateway},ip={ip_address}/24,ip6=dhcp,type=veth "
          f"--rootfs {storage}:{resources['rootfs_size']} --unprivileged {unprivileged} --ostype ubuntu --arch amd64 2>&1",
                             check=False, capture_output=True, cfg=cfg)
+    # Classify the create output once; it is consulted on both the failure and the success path
+    create_result = create_result or ""
+    has_tar_errors = "tar:" in create_result
+    has_mknod_errors = "Cannot mknod" in create_result
     
     # Check if container was actually created despite tar warnings
     # Tar errors for postfix dev files are non-fatal - check if container config exists
@@ -1305,7 +2010,7 @@ def setup_container_base(container_cfg, cfg, privileged=False):
     
     if not config_check or "missing" in config_check:
         # Container was not created - check if it's due to tar errors
-        if "tar:" in create_result and "Cannot mknod" in create_result:
+        if has_tar_errors and has_mknod_errors:
             # Try to create container again with --skip-old-files or ignore tar errors
             print(f"  ⚠ Container creation had tar errors, retrying with error tolerance...", flush=True)
             # Wait a moment for cleanup
@@ -1324,7 +2029,8 @@ def setup_container_base(container_cfg, cfg, privileged=False):
                                check=False, capture_output=True, timeout=10, cfg=cfg)
             if not config_check or "missing" in config_check:
                 print(f"ERROR: Container {container_id} creation failed after retry", file=sys.stderr)
-                print(f"Error output: {retry_result[-500:] if retry_result else create_result[-500:]}", file=sys.stderr)
+                error_tail = (retry_result or create_result or "")[-500:]
+                print(f"Error output: {error_tail}", file=sys.stderr)
                 return False
         else:
             # Other error - fail immediately
@@ -1334,21 +2040,29 @@ def setup_container_base(container_cfg, cfg, privileged=False):
             return False
     else:
         # Container config exists - tar errors were non-fatal
-        if "tar:" in create_result or "Cannot mknod" in create_result:
+        if has_tar_errors or has_mknod_errors:
             print(f"  ⚠ Non-fatal tar errors during container creation (postfix dev files)", flush=True)
     
-    # Verify container exists
-    if not container_exists(proxmox_host, container_id, cfg=cfg):
-        print(f"ERROR: Container {container_id} was not created", file=sys.stderr)
-        return False
+    # Share one apt archive directory on the host between containers (opt-in; apt-cacher-ng already
+    # caches downloads, and containers sharing the directory also share its download lock).
+    # Unprivileged containers only: the directory is owned by host uid 100000 (their root), and
+    # files written by a privileged container's root would be unremovable from the others
+    apt_archive_dir = cfg.get('proxmox_apt_archive_dir')
+    shared_archive = bool(apt_archive_dir) and not privileged
+    if shared_archive:
+        print(f"Mounting shared apt archive {apt_archive_dir}...")
+        ssh_exec(proxmox_host,
+                 f"mkdir -p {apt_archive_dir}/partial && "
+                 f"chown 100000:100000 {apt_archive_dir} {apt_archive_dir}/partial && "
+                 f"pct set {container_id} -mp0 {apt_archive_dir},mp=/var/cache/apt/archives",
+                 check=False, timeout=30, cfg=cfg)
     
     # Start container
     print("Starting container...")
     start_result = ssh_exec(proxmox_host, f"pct start {container_id} 2>&1", check=False, capture_output=True, cfg=cfg)
-    if start_result and ("error" in start_result.lower() or "failed" in start_result.lower() or "not found" in start_result.lower()):
+    if start_result and PCT_START_ERROR_RE.search(start_result):
         print(f"ERROR: Failed to start container {container_id}: {start_result}", file=sys.stderr)
         return False
-    time.sleep(cfg['waits']['container_startup'])
     
     # Verify container is actually running before trying to exec
     status_check = ssh_exec(proxmox_host, f"pct status {container_id} 2>&1", check=False, capture_output=True, cfg=cfg)
@@ -1358,64 +2072,42 @@ def setup_container_base(container_cfg, cfg, privileged=False):
     
     # Configure network
     print("Configuring network...")
-    pct_exec(proxmox_host, container_id,
-         f"ip link set eth0 up && ip addr add {ip_address}/24 dev eth0 2>/dev/null || true && ip route add default via {gateway} dev eth0 2>/dev/null || true && sleep 2",
-         check=False, timeout=10, cfg=cfg)
-    time.sleep(cfg['waits']['network_config'])
+    network_state = pct_exec(proxmox_host, container_id, network_setup_cmd(ip_address, gateway),
+                             check=False, capture_output=True, timeout=15, cfg=cfg)
+    if output_token(network_state) != "network_ok":
+        print("  ⚠ Network configuration could not be verified", flush=True)
     
     # Wait for container
     if not wait_for_container(proxmox_host, container_id, ip_address, cfg=cfg):
         print("WARNING: Container may not be fully ready, but continuing...")
     
-    # Create user and configure sudo
-    default_user = cfg['users']['default_user']
-    sudo_group = cfg['users']['sudo_group']
-    print("Creating user and configuring sudo...")
-    pct_exec(proxmox_host, container_id,
-         f"useradd -m -s /bin/bash -G {sudo_group} {default_user} 2>/dev/null || echo User exists; "
-         f"echo '{default_user} ALL=(ALL) NOPASSWD: ALL' | tee /etc/sudoers.d/{default_user}; "
-         f"chmod 440 /etc/sudoers.d/{default_user}; "
-         f"mkdir -p /home/{default_user}/.ssh; chown -R {default_user}:{default_user} /home/{default_user}; chmod 700 /home/{default_user}/.ssh",
-         check=False, cfg=cfg)
-    
-    # Setup SSH key
-    print("Setting up SSH key...")
-    setup_ssh_key(proxmox_host, container_id, ip_address, cfg)
+    def setup_user_and_ssh_key():
+        # Create user and configure sudo, then install the SSH key (chowned to that user)
+        pct_exec(proxmox_host, container_id, user_setup_cmd(cfg), check=False, cfg=cfg)
+        setup_ssh_key(proxmox_host, container_id, ip_address, cfg)
     
     # Configure DNS
-    print("Configuring DNS...")
-    dns_servers = cfg['dns']['servers']
-    dns_cmd = " && ".join([f"echo 'nameserver {dns}' >> /etc/resolv.conf" for dns in dns_servers])
-    pct_exec(proxmox_host, container_id,
-         f"echo 'nameserver {dns_servers[0]}' > /etc/resolv.conf && {dns_cmd.replace(dns_servers[0], '', 1).lstrip(' && ')}",
-         check=False, cfg=cfg)
-    
-    # Fix apt sources
-    print("Fixing apt sources...")
-    fix_sources_cmd = (
-        "if grep -q oracular /etc/apt/sources.list; then "
-        "sed -i 's/oracular/plucky/g' /etc/apt/sources.list && "
-        "sed -i 's|old-releases.ubuntu.com|archive.ubuntu.com|g' /etc/apt/sources.list 2>/dev/null || true && "
-        "sed -i 's/plucky main/plucky main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/plucky-updates main/plucky-updates main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/plucky-security main/plucky-security main universe multiverse/g' /etc/apt/sources.list; "
-        "elif grep -q noble /etc/apt/sources.list; then "
-        "sed -i 's/noble main/noble main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/noble-updates main/noble-updates main universe multiverse/g' /etc/apt/sources.list && "
-        "sed -i 's/noble-security main/noble-security main universe multiverse/g' /etc/apt/sources.list; "
-        "fi"
-    )
-    pct_exec(proxmox_host, container_id, fix_sources_cmd, check=False, cfg=cfg)
+    dns_full_cmd = dns_config_cmd(cfg['dns']['servers'])
+    
+    # Fix apt sources and apply the lab apt defaults (keeping .debs only for the shared archive)
+    apt_conf_cmd = FIX_SOURCES_CMD + "; " + APT_CONF_CMD
+    if shared_archive:
+        apt_conf_cmd += "; " + APT_KEEP_DEBS_CMD
+    
+    # These steps touch unrelated files, so run them concurrently instead of one round trip after another
+    steps = [
+        ("Creating user, configuring sudo and SSH key", setup_user_and_ssh_key),
+        ("Configuring DNS", lambda: pct_exec(proxmox_host, container_id, dns_full_cmd, check=False, cfg=cfg)),
+        ("Fixing apt sources", lambda: pct_exec(proxmox_host, container_id, apt_conf_cmd, check=False, cfg=cfg)),
+    ]
     
     # Configure apt cache (if apt-cache container exists)
-    apt_cache_containers = [c for c in cfg['containers'] if c['type'] == 'apt-cache']
-    if apt_cache_containers:
-        apt_cache_ip = apt_cache_containers[0]['ip_address']
-        apt_cache_port = cfg['apt_cache_port']
-        print("Configuring apt cache...")
-        pct_exec(proxmox_host, container_id,
-                 f"echo 'Acquire::http::Proxy \"http://{apt_cache_ip}:{apt_cache_port}\";' > /etc/apt/apt.conf.d/01proxy || true",
-                 check=False, cfg=cfg)
+    proxy_cmd = apt_proxy_cmd(cfg)
+    if proxy_cmd:
+        steps.append(("Configuring apt cache",
+                      lambda: pct_exec(proxmox_host, container_id, proxy_cmd, check=False, cfg=cfg)))
+    
+    run_concurrently(steps)
     
     return container_id
 
@@ -1439,22 +2131,37 @@ def create_container_pgsql(container_cfg, cfg):
     postgresql_port = params.get('port', 5432)
     data_dir = params.get('data_dir', '/var/lib/postgresql/data')
     
-    # Update and upgrade (already done in setup_container_base, but ensure packages are up to date)
-    print("Updating package lists...", flush=True)
-    pct_exec(proxmox_host, container_id,
-         "DEBIAN_FRONTEND=noninteractive apt update -y 2>&1 | tail -10",
-         check=False, timeout=120, cfg=cfg)
-    
-    print("Upgrading to latest Ubuntu distribution (25.04)...", flush=True)
-    pct_exec(proxmox_host, container_id,
-         "DEBIAN_FRONTEND=noninteractive apt dist-upgrade -y 2>&1 | tail -10",
-         check=False, timeout=300, cfg=cfg)
-    
-    # Install PostgreSQL
-    print(f"Installing PostgreSQL {postgresql_version}...", flush=True)
-    pct_exec(proxmox_host, container_id,
-         f"DEBIAN_FRONTEND=noninteractive apt install -y postgresql-{postgresql_version} postgresql-contrib 2>&1 | tail -10",
-         check=False, timeout=300, cfg=cfg)
+    # Update (unless fresh), upgrade and install PostgreSQL in one streamed apt run, so the
+    # lock wait, apt start-up and dpkg triggers are paid once; skipped entirely when the
+    # container's template already ships the package
+    print(f"Updating, upgrading to latest Ubuntu distribution (25.04) and installing PostgreSQL {postgresql_version}...", flush=True)
+    postgresql_package = f"postgresql-{postgresql_version}"
+    update_cmd = "" if apt_update_is_fresh(container_id) else f"{APT_GET} update -y 2>&1; "
+    # With verify_strict, a clean apt exit must also leave the package recorded as installed
+    verify_cmd = (f"[ $apt_rc -ne 0 ] || {dpkg_installed_cmd(postgresql_package)} || apt_rc=100; "
+                  if cfg['verify_strict'] else "")
+    install_output, install_aborted = pct_exec_stream(proxmox_host, container_id,
+         f"if {dpkg_installed_cmd(postgresql_package)}; then echo preinstalled; apt_rc=0; else " +
+         apt_lock_wait_cmd(container_id) + update_cmd +
+         f"{APT_GET} dist-upgrade -y 2>&1; "
+         f"{APT_GET} install -y {postgresql_package} postgresql-contrib 2>&1; "
+         "apt_rc=$?; " + verify_cmd + "fi; echo apt_rc=$apt_rc",
+         abort_pattern=APT_FATAL_RE, max_lines=11, timeout=600, cfg=cfg)
+    # The apt_rc= line is missing when the stream was cut short (apt error or timeout)
+    apt_rc = ""
+    if "apt_rc=" in install_output:
+        install_output, _, apt_rc = install_output.rpartition("apt_rc=")
+    if install_output.strip() == "preinstalled":
+        print(f"  {postgresql_package} is already installed in the template, skipping apt", flush=True)
+    elif install_output.strip() and not cfg['stream_output']:
+        print(install_output.strip(), flush=True)
+    if install_aborted or apt_rc.strip() != "0":
+        apt_error = APT_ERROR_RE.search(install_output)
+        if apt_error:
+            print(f"  ⚠ apt: {apt_error.group(0)}", flush=True)
+        print(f"  ✗ PostgreSQL {postgresql_version} installation failed", flush=True)
+        return False
+    _APT_LOCK_CLEAN[container_id] = time.monotonic()
     
     # Configure PostgreSQL
     print("Configuring PostgreSQL...", flush=True)
@@ -1462,32 +2169,26 @@ def create_container_pgsql(container_cfg, cfg):
          f"systemctl enable postgresql && systemctl start postgresql",
          check=False, timeout=30, cfg=cfg)
     
-    time.sleep(cfg['waits']['service_start'])
+    # The config edits below do not need the server up, so they run while it starts; the
+    # restart afterwards is what has to be waited for
     
-    # Configure PostgreSQL to listen on all interfaces
+    # Listen on all interfaces and the configured port, allow the lab network in pg_hba.conf and
+    # restart, in one round trip
     print("Configuring PostgreSQL network settings...")
+    pg_conf_dir = f"/etc/postgresql/{postgresql_version}/main"
+    hba_line = f"host all all {cfg['network']} md5"
     pct_exec(proxmox_host, container_id,
-         f"sed -i \"s/#listen_addresses = 'localhost'/listen_addresses = '*'/\" /etc/postgresql/{postgresql_version}/main/postgresql.conf 2>/dev/null || "
-         f"sed -i \"s/listen_addresses = 'localhost'/listen_addresses = '*'/\" /etc/postgresql/{postgresql_version}/main/postgresql.conf 2>/dev/null || true",
-         check=False, cfg=cfg)
-    
-    # Update pg_hba.conf to allow connections
-    pct_exec(proxmox_host, container_id,
-         f"echo 'host all all 10.11.3.0/24 md5' >> /etc/postgresql/{postgresql_version}/main/pg_hba.conf 2>/dev/null || true",
-         check=False, cfg=cfg)
-    
-    # Restart PostgreSQL
-    pct_exec(proxmox_host, container_id,
+         "sed -i -e \"s/^#\\?listen_addresses = .*/listen_addresses = '*'/\" "
+         f"-e \"s/^#\\?port = .*/port = {postgresql_port}/\" {pg_conf_dir}/postgresql.conf 2>/dev/null; "
+         f"grep -qxF '{hba_line}' {pg_conf_dir}/pg_hba.conf 2>/dev/null || "
+         f"echo '{hba_line}' >> {pg_conf_dir}/pg_hba.conf 2>/dev/null; "
          "systemctl restart postgresql",
          check=False, cfg=cfg)
     
-    time.sleep(cfg['waits']['service_start'])
-    
-    # Verify PostgreSQL is running
-    pg_check = pct_exec(proxmox_host, container_id,
-                       "systemctl is-active postgresql 2>/dev/null || echo inactive",
-                       check=False, capture_output=True, cfg=cfg)
-    if "active" in pg_check:
+    # Verify PostgreSQL is running: poll from 0.1s, backing off up to service_start, instead of
+    # a fixed service_start sleep
+    if wait_for_service_active(proxmox_host, container_id, "postgresql", attempts=8, base_delay=0.1,
+                               max_delay=cfg['waits']['service_start'], cfg=cfg):
         print("✓ PostgreSQL installed and running")
     else:
         print("⚠ PostgreSQL may not be running")
@@ -1496,152 +2197,99 @@ def create_container_pgsql(container_cfg, cfg):
     return True
 
 
+def haproxy_ports(container_cfg):
+    """HAProxy http/https/stats ports from the container params, falling back to HAPROXY_DEFAULT_PORTS"""
+    params = container_cfg.get('params', {})
+    return {name: params.get(name, default) for name, default in HAPROXY_DEFAULT_PORTS.items()}
+
+
 def create_container_haproxy(container_cfg, cfg):
     """Create HAProxy load balancer container - method for type 'haproxy'"""
     proxmox_host = cfg['proxmox_host']
     container_id = setup_container_base(container_cfg, cfg, privileged=True)
     
-    params = container_cfg.get('params', {})
-    http_port = params.get('http_port', 80)
-    https_port = params.get('https_port', 443)
-    stats_port = params.get('stats_port', 8404)
+    ports = haproxy_ports(container_cfg)
     
-    # Get Swarm node IPs for backend
-    swarm_nodes = cfg['swarm_managers'] + cfg['swarm_workers']
-    backend_servers = []
-    for i, node in enumerate(swarm_nodes, 1):
-        backend_servers.append(f"    server node{i} {node['ip_address']}:80 check")
+    # Backend "server" lines for the Swarm nodes
+    backend_servers = "\n".join(HAPROXY_SERVER_LINE.format(idx=i, ip=node['ip_address'])
+                                for i, node in enumerate(cfg['swarm_nodes'], 1))
     
     # Install HAProxy - Ubuntu 25.04 may not have haproxy in main repo, try universe
     print("Installing HAProxy...")
-    # First, fix any dpkg issues
-    pct_exec(proxmox_host, container_id,
-         "dpkg --configure -a 2>&1 || true",
-         check=False, timeout=60, cfg=cfg)
-    
-    install_result = pct_exec(proxmox_host, container_id,
-         "DEBIAN_FRONTEND=noninteractive apt update -qq 2>&1 && "
-         "DEBIAN_FRONTEND=noninteractive apt install -y haproxy 2>&1",
-         check=False, capture_output=True, timeout=120, cfg=cfg)
-    
-    # Verify installation
-    haproxy_check = pct_exec(proxmox_host, container_id,
-                           "command -v haproxy >/dev/null 2>&1 && echo installed || echo not_installed",
-                           check=False, capture_output=True, timeout=10, cfg=cfg)
-    
-    if haproxy_check and "not_installed" in haproxy_check:
+    # Wait out any boot-time apt run, fix any dpkg issues, update and install in one streamed
+    # exec; each step reports its exit code as a ===STEP:name:rc=== line
+    # A template that already ships haproxy skips apt altogether
+    install_script = (
+        "set +e\n"
+        f"if {dpkg_installed_cmd('haproxy')}; then echo preinstalled; {step_marker('install')}; else\n"
+        f"{apt_lock_wait_cmd(container_id)}dpkg --configure -a >/dev/null 2>&1; {step_marker('dpkg')}\n"
+        f"DEBIAN_FRONTEND=noninteractive apt update -qq 2>&1; {step_marker('update')}\n"
+        f"DEBIAN_FRONTEND=noninteractive apt install -y haproxy 2>&1; {step_marker('install')}\n"
+    )
+    if cfg['verify_strict']:
+        # Otherwise a clean apt exit already proves the install
+        install_script += f"{dpkg_installed_cmd('haproxy')}; {step_marker('verify')}\n"
+    install_script += "fi\n"
+    install_result, install_aborted = pct_exec_stream(proxmox_host, container_id, install_script,
+         abort_pattern=APT_FATAL_RE, max_lines=40, timeout=300, cfg=cfg)
+    install_steps = parse_step_markers(install_result)
+    if install_result.startswith("preinstalled"):
+        print("  haproxy is already installed in the template, skipping apt", flush=True)
+    if install_aborted:
+        apt_error = APT_ERROR_RE.search(install_result)
+        print(f"  ⚠ apt stopped early: {apt_error.group(0) if apt_error else install_result[-200:]}", flush=True)
+    for step in ('dpkg', 'update'):
+        if install_steps.get(step, 0) != 0:
+            print(f"  ⚠ {step}: exited with status {install_steps[step]}", flush=True)
+    haproxy_installed = (not install_aborted and install_steps.get('install') == 0 and
+                         install_steps.get('verify', 0) == 0)
+    
+    if not haproxy_installed:
         print("  ⚠ haproxy package not found, trying to install from universe...", flush=True)
-        # Fix dpkg again before retry
-        pct_exec(proxmox_host, container_id,
-             "dpkg --configure -a 2>&1 || true",
-             check=False, timeout=60, cfg=cfg)
-        pct_exec(proxmox_host, container_id,
-             "DEBIAN_FRONTEND=noninteractive apt install -y --no-install-recommends haproxy 2>&1 || "
-             "echo 'haproxy installation failed'",
-             check=False, timeout=120, cfg=cfg)
-        # Check again
+        # Fix dpkg again, retry without recommends and check the package state in one round trip
         haproxy_check = pct_exec(proxmox_host, container_id,
-                               "command -v haproxy >/dev/null 2>&1 && echo installed || echo not_installed",
-                               check=False, capture_output=True, timeout=10, cfg=cfg)
-        if haproxy_check and "not_installed" in haproxy_check:
+             "dpkg --configure -a >/dev/null 2>&1; "
+             "DEBIAN_FRONTEND=noninteractive apt install -y --no-install-recommends haproxy >/dev/null 2>&1; "
+             f"{dpkg_installed_cmd('haproxy')} && echo installed || echo not_installed",
+             check=False, capture_output=True, timeout=180, cfg=cfg)
+        if output_token(haproxy_check) != "installed":
             print("  ✗ Failed to install HAProxy", flush=True)
             return False
     
     # Create HAProxy configuration
     print("Configuring HAProxy...")
-    backend_servers_str = "\n".join(backend_servers)
-    haproxy_config = f"""global
-    log /dev/log local0
-    log /dev/log local1 notice
-    chroot /var/lib/haproxy
-    stats socket /run/haproxy/admin.sock mode 660 level admin
-    stats timeout 30s
-    user haproxy
-    group haproxy
-    daemon
-
-defaults
-    log global
-    mode http
-    option httplog
-    option dontlognull
-    timeout connect 5000ms
-    timeout client 50000ms
-    timeout server 50000ms
-    errorfile 400 /etc/haproxy/errors/400.http
-    errorfile 403 /etc/haproxy/errors/403.http
-    errorfile 408 /etc/haproxy/errors/408.http
-    errorfile 500 /etc/haproxy/errors/500.http
-    errorfile 502 /etc/haproxy/errors/502.http
-    errorfile 503 /etc/haproxy/errors/503.http
-    errorfile 504 /etc/haproxy/errors/504.http
-
-# Stats page
-listen stats
-    bind *:{stats_port}
-    stats enable
-    stats uri /
-    stats refresh 30s
-    stats admin if TRUE
-
-# Frontend for HTTP
-frontend http_frontend
-    bind *:{http_port}
-    default_backend swarm_backend
-
-# Frontend for HTTPS
-frontend https_frontend
-    bind *:{https_port}
-    default_backend swarm_backend
-
-# Backend for Docker Swarm nodes
-backend swarm_backend
-    balance roundrobin
-    option httpchk GET /
-    http-check expect status 200
-{backend_servers_str}
-"""
-    
-    # Write HAProxy config using base64 to avoid quote issues
-    import base64
-    config_b64 = base64.b64encode(haproxy_config.encode()).decode()
-    pct_exec(proxmox_host, container_id,
-         f"echo {config_b64} | base64 -d > /etc/haproxy/haproxy.cfg",
-         check=False, cfg=cfg)
-    
-    # Fix systemd service for LXC (disable PrivateNetwork)
-    print("Configuring HAProxy systemd service for LXC...")
-    pct_exec(proxmox_host, container_id,
-         "sed -i 's/PrivateNetwork=.*/PrivateNetwork=no/' /usr/lib/systemd/system/haproxy.service 2>/dev/null || true",
-         check=False, cfg=cfg)
-    pct_exec(proxmox_host, container_id,
-         "systemctl daemon-reload",
-         check=False, cfg=cfg)
-    
-    # Enable and start HAProxy
-    print("Starting HAProxy service...")
-    pct_exec(proxmox_host, container_id,
-         "systemctl enable haproxy && systemctl start haproxy",
-         check=False, cfg=cfg)
-    
-    # If systemd fails, start manually as fallback
-    haproxy_check = pct_exec(proxmox_host, container_id,
-                            "systemctl is-active haproxy 2>/dev/null || echo inactive",
-                            check=False, capture_output=True, cfg=cfg)
-    if "inactive" in haproxy_check:
-        print("Systemd start failed, starting HAProxy manually...")
-        pct_exec(proxmox_host, container_id,
-                "haproxy -f /etc/haproxy/haproxy.cfg -D",
-                check=False, cfg=cfg)
-    
-    time.sleep(cfg['waits']['service_start'])
-    
-    # Verify HAProxy is running
-    haproxy_check = pct_exec(proxmox_host, container_id,
-                             "systemctl is-active haproxy 2>/dev/null || echo inactive",
-                             check=False, capture_output=True, cfg=cfg)
-    if "active" in haproxy_check:
+    haproxy_config = HAPROXY_CONFIG_TEMPLATE.format(backend_servers=backend_servers, **ports)
+    
+    # Copy the config in directly rather than inlining it base64-encoded in a pct exec command line
+    if not pct_push_content(proxmox_host, container_id, haproxy_config, "/etc/haproxy/haproxy.cfg", cfg=cfg):
+        print("  ⚠ Failed to write /etc/haproxy/haproxy.cfg", flush=True)
+    
+    # Fix systemd service for LXC (disable PrivateNetwork via a drop-in), validate the config,
+    # reload, enable and start HAProxy, poll until active (up to service_start) and fall back to
+    # starting it manually, all in one round trip; the last line is STATE=active|manual|dead
+    print("Configuring HAProxy systemd service for LXC and starting HAProxy...")
+    poll_count = max(1, int(cfg['waits']['service_start'] * 4))
+    service_state = pct_exec(proxmox_host, container_id,
+         "mkdir -p /etc/systemd/system/haproxy.service.d && "
+         "printf '[Service]\\nPrivateNetwork=no\\n' > /etc/systemd/system/haproxy.service.d/lxc.conf; "
+         "haproxy -c -q -f /etc/haproxy/haproxy.cfg >/dev/null 2>&1 || echo config_invalid; "
+         "systemctl daemon-reload && systemctl enable --now haproxy >/dev/null 2>&1; "
+         f"for i in $(seq 1 {poll_count}); do "
+         "systemctl is-active --quiet haproxy && { echo STATE=active; exit 0; }; sleep 0.25; done; "
+         "echo systemd_failed; "
+         "haproxy -f /etc/haproxy/haproxy.cfg -D >/dev/null 2>&1; sleep 0.5; "
+         "pgrep -x haproxy >/dev/null && { echo STATE=manual; exit 0; }; "
+         "echo STATE=dead",
+         check=False, capture_output=True, timeout=60 + poll_count // 4, cfg=cfg) or ""
+    if "config_invalid" in service_state:
+        print("  ⚠ haproxy -c reports an invalid /etc/haproxy/haproxy.cfg", flush=True)
+    if "systemd_failed" in service_state:
+        print("Systemd start failed, started HAProxy manually...")
+    haproxy_state = service_state.rpartition("STATE=")[2].strip()
+    if haproxy_state == "active":
         print("✓ HAProxy installed and running")
+    elif haproxy_state == "manual":
+        print("✓ HAProxy installed and running (outside systemd)")
     else:
         print("⚠ HAProxy may not be running")
     
@@ -1663,14 +2311,148 @@ def create_container_swarm_node(container_cfg, cfg):
     return True
 
 
+# Container type -> creation method
+CONTAINER_TYPES = {
+    'apt-cache': create_container_apt_cache,
+    'pgsql': create_container_pgsql,
+    'haproxy': create_container_haproxy,
+    'swarm-manager': create_container_swarm_manager,
+    'swarm-node': create_container_swarm_node,
+}
+
+
+def classify_swarm_output(output):
+    """Scan swarm init/join output once; return 'already', 'joined', 'error' or '' (in that priority)"""
+    found = {match.lastgroup for match in SWARM_OUTPUT_RE.finditer(output or "")}
+    for outcome in ('already', 'joined', 'error'):
+        if outcome in found:
+            return outcome
+    return ""
+
+
+def unknown_types(cfg):
+    """Return error messages for configured containers/templates whose type has no handler"""
+    errors = [f"container '{c['name']}' has unknown type '{c['type']}'"
+              for c in cfg['containers'] if c['type'] not in CONTAINER_TYPES]
+    errors += [f"template '{t['name']}' has unknown type '{t['type']}'"
+               for t in cfg['templates'] if t['type'] not in TEMPLATE_TYPES]
+    return errors
+
+
+def deploy_swarm_node(container_cfg, template_path, cfg):
+    """Create, start and prepare one swarm container; returns its final docker probe"""
+    proxmox_host = cfg['proxmox_host']
+    gateway = cfg['gateway']
+    container_id = container_cfg['id']
+    hostname = container_cfg['hostname']
+    ip_address = container_cfg['ip_address']
+    print(f"\nDeploying container {container_id} ({hostname})...", flush=True)
+    
+    # Destroy if exists (destroy_container does its own existence check)
+    destroy_container(proxmox_host, container_id, cfg=cfg)
+    
+    # Get container resources from container config
+    resources = container_cfg.get('resources', {})
+    if not resources:
+        # Default fallback
+        resources = {'memory': 4096, 'swap': 4096, 'cores': 8, 'rootfs_size': 40}
+    storage = cfg['proxmox_storage']
+    bridge = cfg['proxmox_bridge']
+    
+    # Create container
+    print(f"  {hostname}: Creating container {container_id} from template...", flush=True)
+    ssh_exec(proxmox_host,
+            f"pct create {container_id} {template_path} "
+            f"--hostname {hostname} "
+            f"--memory {resources['memory']} --swap {resources['swap']} --cores {resources['cores']} "
+            f"--net0 name=eth0,bridge={bridge},firewall=1,gw={gateway},ip={ip_address}/24,ip6=dhcp,type=veth "
+            f"--rootfs {storage}:{resources['rootfs_size']} --unprivileged 0 --ostype ubuntu --arch amd64",
+            check=True, cfg=cfg)
+    
+    # Configure features
+    print(f"  {hostname}: Configuring container features...", flush=True)
+    ssh_exec(proxmox_host, f"pct set {container_id} --features nesting=1,keyctl=1,fuse=1", check=False, cfg=cfg)
+    
+    # Configure sysctl for manager
+    is_manager = container_cfg['type'] == 'swarm-manager'
+    if is_manager:
+        print(f"  {hostname}: Configuring LXC container for sysctl access...", flush=True)
+        ssh_exec(proxmox_host, f"pct set {container_id} -lxc.cgroup2.devices.allow 'c 10:200 rwm' 2>/dev/null || true", check=False, cfg=cfg)
+        ssh_exec(proxmox_host, f"pct set {container_id} -lxc.mount.auto 'proc:rw sys:rw' 2>/dev/null || true", check=False, cfg=cfg)
+    
+    # Start container
+    print(f"  {hostname}: Starting container...", flush=True)
+    ssh_exec(proxmox_host, f"pct start {container_id}", check=True, cfg=cfg)
+    
+    # Wait for container
+    wait_for_container(proxmox_host, container_id, ip_address, cfg=cfg)
+    
+    # Setup SSH key
+    print(f"  {hostname}: Setting up SSH key...", flush=True)
+    setup_ssh_key(proxmox_host, container_id, ip_address, cfg)
+    
+    # Configure apt cache for deployed nodes
+    proxy_cmd = apt_proxy_cmd(cfg)
+    if proxy_cmd:
+        print(f"  {hostname}: Configuring apt cache...", flush=True)
+        pct_exec(proxmox_host, container_id, proxy_cmd + " || true", check=False, cfg=cfg)
+    
+    # Verify Docker
+    print(f"  {hostname}: Verifying Docker installation...", flush=True)
+    docker_state = probe_key_values(proxmox_host, container_id,
+                                    "echo bin=$(command -v docker >/dev/null 2>&1 && echo installed || echo missing); "
+                                    "echo version=$(docker --version 2>/dev/null | head -1)",
+                                    cfg=cfg)
+    docker_installed = docker_state.get('bin') == "installed"
+    if not docker_installed:
+        print(f"  {hostname}: Docker not installed, installing Docker...", flush=True)
+        # Use Docker's official installation script
+        push_cached_download(proxmox_host, container_id, GET_DOCKER_URL, "get-docker.sh", GET_DOCKER_PATH, cfg=cfg)
+        install_result = pct_exec(proxmox_host, container_id, DOCKER_INSTALL_CMD,
+                                check=False, capture_output=True, timeout=300, cfg=cfg)
+    
+    # Start Docker, then verify the install and the service in the same round trip
+    print(f"  {hostname}: Starting Docker service...", flush=True)
+    docker_state = probe_key_values(proxmox_host, container_id,
+                                    "systemctl enable --now docker 2>/dev/null; "
+                                    "echo bin=$(command -v docker >/dev/null 2>&1 && echo installed || echo missing); "
+                                    "for i in 1 2 3 4; do s=$(systemctl is-active docker 2>/dev/null); "
+                                    "[ \"$s\" = active ] && break; sleep 1; done; "
+                                    "echo service=${s:-inactive}",
+                                    timeout=30, cfg=cfg)
+    if not docker_installed:
+        if docker_state.get('bin') == "installed":
+            print(f"  {hostname}: ✓ Docker installed successfully", flush=True)
+        else:
+            print(f"  {hostname}: ⚠ Docker installation may have failed", flush=True)
+    
+    # Verify Docker is running
+    if docker_state.get('service') == "active":
+        print(f"  {hostname}: ✓ Docker service is running", flush=True)
+    else:
+        print(f"  {hostname}: ⚠ Docker service may not be running", flush=True)
+    
+    # Manager-specific setup
+    if is_manager:
+        print(f"  {hostname}: Ensuring SSH service is running on manager...", flush=True)
+        pct_exec(proxmox_host, container_id, "systemctl start ssh 2>/dev/null || true", check=False, cfg=cfg)
+        print(f"  {hostname}: Configuring sysctl for Docker containers...", flush=True)
+        pct_exec(proxmox_host, container_id,
+                "sysctl -w net.ipv4.ip_unprivileged_port_start=0 2>/dev/null || true; "
+                "echo 'net.ipv4.ip_unprivileged_port_start=0' >> /etc/sysctl.conf 2>/dev/null || true",
+                check=False, cfg=cfg)
+    
+    print(f"✓ Container {container_id} ({hostname}) deployed successfully", flush=True)
+    return docker_state
+
+
 def deploy_swarm(cfg):
     """Deploy Docker Swarm"""
     proxmox_host = cfg['proxmox_host']
-    gateway = cfg['gateway']
     
     # Get swarm container configs from containers list
-    swarm_manager_configs = [c for c in cfg['containers'] if c['type'] == 'swarm-manager']
-    swarm_worker_configs = [c for c in cfg['containers'] if c['type'] == 'swarm-node']
+    swarm_manager_configs = cfg['containers_by_type'].get('swarm-manager', [])
+    swarm_worker_configs = cfg['containers_by_type'].get('swarm-node', [])
     
     if not swarm_manager_configs or not swarm_worker_configs:
         print("ERROR: Swarm manager or worker containers not found in configuration", file=sys.stderr)
@@ -1680,176 +2462,43 @@ def deploy_swarm(cfg):
     template_path = get_template_path('docker-tmpl', cfg)
     print(f"Using template: {template_path}")
     
-    # Deploy all swarm containers (managers + workers)
+    # Deploy all swarm containers (managers + workers); each targets its own container ID,
+    # so they are provisioned in parallel
     all_swarm_configs = swarm_manager_configs + swarm_worker_configs
+    with ThreadPoolExecutor(max_workers=min(cfg['parallel_builds'], len(all_swarm_configs))) as executor:
+        # container_id -> final docker probe ({'bin': ..., 'service': ...}), reused for the manager below
+        docker_states = dict(zip((c['id'] for c in all_swarm_configs),
+                                 executor.map(lambda c: deploy_swarm_node(c, template_path, cfg), all_swarm_configs)))
     
-    for container_cfg in all_swarm_configs:
-        container_id = container_cfg['id']
-        hostname = container_cfg['hostname']
-        ip_address = container_cfg['ip_address']
-        print(f"\nDeploying container {container_id} ({hostname})...")
-        
-        # Destroy if exists
-        if container_exists(proxmox_host, container_id, cfg=cfg):
-            print(f"  Destroying existing container {container_id}...")
-            destroy_container(proxmox_host, container_id, cfg=cfg)
-        
-        # Get container resources from container config
-        resources = container_cfg.get('resources', {})
-        if not resources:
-            # Default fallback
-            resources = {'memory': 4096, 'swap': 4096, 'cores': 8, 'rootfs_size': 40}
-        storage = cfg['proxmox_storage']
-        bridge = cfg['proxmox_bridge']
-        
-        # Create container
-        print(f"Creating container {container_id} from template...")
-        ssh_exec(proxmox_host,
-                f"pct create {container_id} {template_path} "
-                f"--hostname {hostname} "
-                f"--memory {resources['memory']} --swap {resources['swap']} --cores {resources['cores']} "
-                f"--net0 name=eth0,bridge={bridge},firewall=1,gw={gateway},ip={ip_address}/24,ip6=dhcp,type=veth "
-                f"--rootfs {storage}:{resources['rootfs_size']} --unprivileged 0 --ostype ubuntu --arch amd64",
-                check=True, cfg=cfg)
-        
-        # Configure features
-        print("Configuring container features...")
-        ssh_exec(proxmox_host, f"pct set {container_id} --features nesting=1,keyctl=1,fuse=1", check=False, cfg=cfg)
-        
-        # Configure sysctl for manager
-        is_manager = container_cfg['type'] == 'swarm-manager'
-        if is_manager:
-            print("Configuring LXC container for sysctl access...")
-            ssh_exec(proxmox_host, f"pct set {container_id} -lxc.cgroup2.devices.allow 'c 10:200 rwm' 2>/dev/null || true", check=False, cfg=cfg)
-            ssh_exec(proxmox_host, f"pct set {container_id} -lxc.mount.auto 'proc:rw sys:rw' 2>/dev/null || true", check=False, cfg=cfg)
-        
-        # Start container
-        print("Starting container...")
-        ssh_exec(proxmox_host, f"pct start {container_id}", check=True, cfg=cfg)
-        time.sleep(cfg['waits']['container_startup'])
-        
-        # Wait for container
-        wait_for_container(proxmox_host, container_id, ip_address, cfg=cfg)
-        
-        # Setup SSH key
-        print("Setting up SSH key...")
-        setup_ssh_key(proxmox_host, container_id, ip_address, cfg)
-        
-        # Configure apt cache for deployed nodes
-        apt_cache_containers = [c for c in cfg['containers'] if c['type'] == 'apt-cache']
-        if apt_cache_containers:
-            apt_cache_ip = apt_cache_containers[0]['ip_address']
-        apt_cache_port = cfg['apt_cache_port']
-        print("Configuring apt cache...")
-        pct_exec(proxmox_host, container_id,
-                    f"echo 'Acquire::http::Proxy \"http://{apt_cache_ip}:{apt_cache_port}\";' > /etc/apt/apt.conf.d/01proxy || true",
-                check=False, cfg=cfg)
-        
-        # Verify Docker
-        print("Verifying Docker installation...")
-        docker_verify = pct_exec(proxmox_host, container_id, 
-                               "command -v docker >/dev/null 2>&1 && docker --version && docker ps 2>&1 | head -5 || echo 'Docker not found'",
-                               check=False, capture_output=True, cfg=cfg)
-        if "Docker not found" in docker_verify or "docker" not in docker_verify.lower():
-            print("Docker not installed, installing Docker...", flush=True)
-            # Use Docker's official installation script
-            docker_install_cmd = (
-                "rm -f /etc/apt/apt.conf.d/01proxy; "
-                "DEBIAN_FRONTEND=noninteractive apt update -qq 2>&1 && "
-                "if command -v curl >/dev/null 2>&1; then "
-                "  curl -fsSL https://get.docker.com -o /tmp/get-docker.sh 2>&1 && "
-                "  sh /tmp/get-docker.sh 2>&1 | tail -20 || "
-                "  (echo 'get.docker.com failed, trying docker.io...' && "
-                "   DEBIAN_FRONTEND=noninteractive apt install -y docker.io 2>&1 | tail -20); "
-                "else "
-                "  echo 'curl not available, installing docker.io...'; "
-                "  DEBIAN_FRONTEND=noninteractive apt install -y docker.io 2>&1 | tail -20; "
-                "fi"
-            )
-            install_result = pct_exec(proxmox_host, container_id, docker_install_cmd,
-                                    check=False, capture_output=True, timeout=300, cfg=cfg)
-            
-            # Verify Docker was installed
-            docker_check = pct_exec(proxmox_host, container_id,
-                                  "command -v docker >/dev/null 2>&1 && echo installed || echo not_installed",
-                                  check=False, capture_output=True, timeout=10, cfg=cfg)
-            if docker_check and "installed" in docker_check:
-                print("  ✓ Docker installed successfully", flush=True)
-            else:
-                print("  ⚠ Docker installation may have failed", flush=True)
-        
-        # Start Docker
-        print("  Starting Docker service...", flush=True)
-        pct_exec(proxmox_host, container_id,
-                    "systemctl enable docker 2>/dev/null && systemctl start docker 2>/dev/null",
-                    check=False, timeout=30, cfg=cfg)
-        
-        # Verify Docker is running
-        time.sleep(3)
-        docker_status = pct_exec(proxmox_host, container_id,
-                               "systemctl is-active docker 2>/dev/null || echo inactive",
-                               check=False, capture_output=True, timeout=10, cfg=cfg)
-        if docker_status and "active" in docker_status:
-            print("  ✓ Docker service is running", flush=True)
-        else:
-            print("  ⚠ Docker service may not be running", flush=True)
-        
-        # Manager-specific setup
-        if is_manager:
-            print("Ensuring SSH service is running on manager...")
-            pct_exec(proxmox_host, container_id, "systemctl start ssh 2>/dev/null || true", check=False, cfg=cfg)
-            print("Configuring sysctl for Docker containers...")
-            pct_exec(proxmox_host, container_id,
-                    "sysctl -w net.ipv4.ip_unprivileged_port_start=0 2>/dev/null || true; "
-                    "echo 'net.ipv4.ip_unprivileged_port_start=0' >> /etc/sysctl.conf 2>/dev/null || true",
-                    check=False, cfg=cfg)
-            time.sleep(cfg['waits']['network_config'])
-        
-        print(f"✓ Container {container_id} ({hostname}) deployed successfully")
-    
-    # Ensure Docker is installed and running on manager (after all containers are created)
+    # Ensure Docker is installed and running on manager (after all containers are created);
+    # the probe taken when it was deployed is reused, so a healthy manager costs no round trips
     manager_config = swarm_manager_configs[0]
     manager_id = manager_config['id']
+    manager_docker = docker_states.get(manager_id, {})
     
-    # Check if Docker is installed
-    docker_check = pct_exec(proxmox_host, manager_id,
-                          "command -v docker >/dev/null 2>&1 && echo 'docker_installed' || echo 'docker_missing'",
-                          check=False, capture_output=True, cfg=cfg)
-    
-    if "docker_missing" in docker_check:
+    if manager_docker.get('bin') != "installed":
         print("\nInstalling Docker on manager...", flush=True)
-        docker_install_cmd = (
-            "rm -f /etc/apt/apt.conf.d/01proxy; "
-            "DEBIAN_FRONTEND=noninteractive apt update -qq 2>&1 && "
-            "if command -v curl >/dev/null 2>&1; then "
-            "  curl -fsSL https://get.docker.com -o /tmp/get-docker.sh 2>&1 && "
-            "  sh /tmp/get-docker.sh 2>&1 | tail -20 || "
-            "  (echo 'get.docker.com failed, trying docker.io...' && "
-            "   DEBIAN_FRONTEND=noninteractive apt install -y docker.io 2>&1 | tail -20); "
-            "else "
-            "  echo 'curl not available, installing docker.io...'; "
-            "  DEBIAN_FRONTEND=noninteractive apt install -y docker.io 2>&1 | tail -20; "
-            "fi"
-        )
-        install_result = pct_exec(proxmox_host, manager_id, docker_install_cmd,
+        push_cached_download(proxmox_host, manager_id, GET_DOCKER_URL, "get-docker.sh", GET_DOCKER_PATH, cfg=cfg)
+        install_result = pct_exec(proxmox_host, manager_id, DOCKER_INSTALL_CMD,
                                 check=False, capture_output=True, timeout=300, cfg=cfg)
         
         # Verify Docker was installed
         docker_check = pct_exec(proxmox_host, manager_id,
                               "command -v docker >/dev/null 2>&1 && echo installed || echo not_installed",
                               check=False, capture_output=True, timeout=10, cfg=cfg)
-        if docker_check and "installed" in docker_check:
+        if output_token(docker_check) == "installed":
             print("  ✓ Docker installed successfully", flush=True)
         else:
             print("  ⚠ Docker installation may have failed", flush=True)
     
-    # Start Docker service
-    print("Starting Docker service on manager...", flush=True)
-    pct_exec(proxmox_host, manager_id,
-        "systemctl enable docker && systemctl start docker && systemctl status docker --no-pager | head -5",
-            check=False, cfg=cfg)
-    
-    time.sleep(cfg['waits']['swarm_init'])
+    if manager_docker.get('service') != "active":
+        # Start Docker service
+        print("Starting Docker service on manager...", flush=True)
+        pct_exec(proxmox_host, manager_id,
+            "systemctl enable --now docker && systemctl status docker --no-pager | head -5",
+                check=False, cfg=cfg)
+        
+        time.sleep(cfg['waits']['swarm_init'])
     
     # Initialize Swarm (use the first manager config)
     manager_config = swarm_manager_configs[0]
@@ -1862,9 +2511,10 @@ def deploy_swarm(cfg):
                          f"docker swarm init --advertise-addr {manager_ip} 2>&1",
                          check=False, capture_output=True, cfg=cfg)
     
-    if "already part of a swarm" in swarm_init:
+    init_outcome = classify_swarm_output(swarm_init)
+    if init_outcome == 'already':
         print("Swarm already initialized, continuing...")
-    elif "Error" in swarm_init:
+    elif init_outcome == 'error':
         print("WARNING: Swarm initialization had errors, but continuing...")
     else:
         print("Swarm initialized successfully")
@@ -1874,13 +2524,9 @@ def deploy_swarm(cfg):
     join_token_output = pct_exec(proxmox_host, manager_id,
                         "docker swarm join-token worker -q 2>&1",
                         check=False, capture_output=True, cfg=cfg)
-    # Extract token - get the last non-empty line that looks like a token
-    join_token = ""
-    for line in join_token_output.strip().split('\n'):
-        line = line.strip()
-        if line and len(line) > 20 and not line.startswith('Error') and not line.startswith('Warning'):
-            join_token = line
-            break
+    # Extract token - the first line that looks like a token
+    token_match = JOIN_TOKEN_RE.search(join_token_output or "")
+    join_token = token_match.group(1) if token_match else ""
     
     if not join_token:
         print(f"ERROR: Could not get worker join token. Output: {join_token_output}", file=sys.stderr)
@@ -1905,95 +2551,152 @@ def deploy_swarm(cfg):
         join_output = pct_exec(proxmox_host, worker_id, join_cmd,
                                   check=False, capture_output=True, cfg=cfg)
         
-        if "already part of a swarm" in join_output:
+        join_outcome = classify_swarm_output(join_output)
+        if join_outcome == 'already':
             print(f"Node {worker_hostname} already part of swarm")
-        elif "This node joined a swarm" in join_output:
+        elif join_outcome == 'joined':
             print(f"✓ Node {worker_hostname} joined swarm successfully")
         else:
             print(f"WARNING: Node {worker_hostname} join had issues:")
             print(join_output)
     
-    # Verify swarm
-    print("\nVerifying swarm status...")
-    pct_exec(proxmox_host, manager_id, "docker node ls 2>&1", check=False, cfg=cfg)
-    
-    # Install Portainer
-    print("\nInstalling Portainer CE...")
-    pct_exec(proxmox_host, manager_id,
-            "docker volume create portainer_data 2>/dev/null || true",
-            check=False, cfg=cfg)
-    
-    # Remove existing portainer if it exists
-    pct_exec(proxmox_host, manager_id,
-            "docker stop portainer 2>/dev/null || true; docker rm portainer 2>/dev/null || true",
-            check=False, cfg=cfg)
-    
+    # Verify swarm and (re)create Portainer in one round trip: node list, volume, removal of
+    # any previous container, run, then poll until running instead of a fixed portainer_start sleep
     portainer_image = cfg['portainer_image']
-    portainer_port = cfg['portainer_port']
-    print("Creating Portainer container...")
-    portainer_cmd = (
+    portainer_wait = cfg['waits']['portainer_start']
+    print("\nVerifying swarm status and installing Portainer CE...")
+    portainer_script = (
+        "docker node ls 2>&1\n"
+        "echo ===PORTAINER===\n"
+        "docker volume create portainer_data >/dev/null 2>&1 || true\n"
+        "docker rm -f portainer >/dev/null 2>&1 || true\n"
         "docker run -d --name portainer --restart=always "
         "--security-opt apparmor=unconfined --network host "
         "-v /var/run/docker.sock:/var/run/docker.sock "
-        "-v portainer_data:/data "
-        f"{portainer_image} 2>&1"
+        f"-v portainer_data:/data {portainer_image} 2>&1 | tail -3\n"
+        f"end=$((SECONDS+{portainer_wait}))\n"
+        "until docker ps --format '{{.Names}}' | grep -q '^portainer$' || [ $SECONDS -ge $end ]; do sleep 0.5; done\n"
+        "sleep 1\n"
+        "echo ===STATUS===\n"
+        "docker ps -a --format '{{.Names}} {{.Status}}' | grep portainer\n"
+        "if docker ps --format '{{.Names}}' | grep -q '^portainer$'; then echo ===RUNNING===; "
+        "else echo ===LOGS===; docker logs portainer 2>&1 | tail -20; fi"
     )
-    pct_exec(proxmox_host, manager_id, portainer_cmd, check=False, cfg=cfg)
-    
-    time.sleep(cfg['waits']['portainer_start'])
-    
+    portainer_output = pct_exec(proxmox_host, manager_id, portainer_script,
+                                check=False, capture_output=True, timeout=300 + portainer_wait, cfg=cfg) or ""
+    node_list, _, portainer_output = portainer_output.partition("===PORTAINER===")
+    if node_list.strip():
+        print(node_list.strip())
+    run_output, _, portainer_output = portainer_output.partition("===STATUS===")
+    portainer_status, running, logs = portainer_output.partition("===RUNNING===")
+    if not running:
+        portainer_status, _, logs = portainer_status.partition("===LOGS===")
+    print("Creating Portainer container...")
+    if run_output.strip():
+        print(run_output.strip())
     print("Verifying Portainer is running...")
-    portainer_status = pct_exec(proxmox_host, manager_id,
-                               "docker ps --format '{{.Names}} {{.Status}}' | grep portainer || docker ps -a --format '{{.Names}} {{.Status}}' | grep portainer",
-                               check=False, capture_output=True, cfg=cfg)
-    if portainer_status:
-        print(f"Portainer status: {portainer_status}")
+    if portainer_status.strip():
+        print(f"Portainer status: {portainer_status.strip()}")
     else:
         print("WARNING: Portainer container not found")
-    
-    # Check Portainer logs if not running
-    portainer_running = pct_exec(proxmox_host, manager_id,
-                                 "docker ps --format '{{.Names}}' | grep -q '^portainer$' && echo yes || echo no",
-                                 check=False, capture_output=True, cfg=cfg)
-    if "no" in portainer_running:
+    if not running:
         print("Portainer failed to start. Checking logs...")
-        logs = pct_exec(proxmox_host, manager_id,
-                       "docker logs portainer 2>&1 | tail -20",
-                       check=False, capture_output=True, cfg=cfg)
-        if logs:
-            print(logs)
+        if logs.strip():
+            print(logs.strip())
     
     print("✓ Docker Swarm deployed")
     return True
 
 
+def wait_for_apt_cache(proxmox_host, container_id, apt_cache_ip, apt_cache_port, max_attempts=10, cfg=None):
+    """Wait until apt-cacher-ng is active and listening, report diagnostics on failure"""
+    # Service state and port check in one round trip, printed as "<state>:<port_open|port_closed>"
+    probe_cmd = (
+        "s=$(systemctl is-active apt-cacher-ng 2>/dev/null); p=port_closed; "
+        f"[ \"$s\" = active ] && nc -z localhost {apt_cache_port} 2>/dev/null && p=port_open; "
+        "echo \"${s:-inactive}:$p\""
+    )
+    # Functional check: the report page is only served once apt-cacher-ng is fully up
+    # ("skipped" when wget is not available in the container)
+    functional_cmd = (
+        "if ! command -v wget >/dev/null 2>&1; then echo skipped; "
+        f"elif timeout 10 wget -qO- http://127.0.0.1:{apt_cache_port}/acng-report.html 2>/dev/null | grep -q 'Apt-Cacher NG'; "
+        "then echo working; else echo notworking; fi"
+    )
+    functional_recheck = 3  # Re-run the (slow) functional check every N attempts
+    service_state = port_state = functional_state = ""
+    port_open_since = None
+    for i in range(1, max_attempts + 1):
+        probe = pct_exec(proxmox_host, container_id, probe_cmd,
+                         check=False, capture_output=True, timeout=10, cfg=cfg)
+        service_state, _, port_state = output_token(probe).partition(':')
+        if service_state == "active" and port_state == "port_open":
+            # Only pay for the functional check once the port has opened, then only every few attempts
+            if port_open_since is None:
+                port_open_since = i
+            if (i - port_open_since) % functional_recheck == 0:
+                functional = pct_exec(proxmox_host, container_id, functional_cmd,
+                                      check=False, capture_output=True, timeout=15, cfg=cfg)
+                functional_state = output_token(functional)
+                if functional_state in ("working", "skipped"):
+                    print(f"  ✓ apt-cache service is ready on {apt_cache_ip}:{apt_cache_port}", flush=True)
+                    return True
+        if i < max_attempts:
+            print(f"  Waiting for apt-cache service... ({i}/{max_attempts})", flush=True)
+            time.sleep(backoff_delay(i, 0.5, max_delay=5))
+    
+    # Collect the failure report and print it once
+    lines = [
+        f"  ✗ ERROR: apt-cache service is not ready after {max_attempts} attempts",
+        f"  Service: {service_state or 'unknown'}, port {apt_cache_port}: {port_state or 'not checked'}, "
+        f"functional test: {functional_state or 'not run'}",
+    ]
+    status = pct_exec(proxmox_host, container_id,
+                      "systemctl status apt-cacher-ng --no-pager 2>&1 | tail -10",
+                      check=False, capture_output=True, timeout=10, cfg=cfg)
+    if status:
+        lines.extend(f"    {line}" for line in status.split('\n'))
+    lines.append("  Cannot proceed with template creation without apt-cache")
+    print("\n".join(lines), flush=True)
+    return False
+
+
 def cmd_deploy():
     """Deploy complete lab: apt-cache, templates, and Docker Swarm"""
     cfg = get_config()
     
-    print("=" * 50)
-    print("Deploying Lab Environment")
-    print("=" * 50)
+    print_banner("Deploying Lab Environment")
+    
+    # Fail before anything is destroyed rather than midway through the deploy
+    type_errors = unknown_types(cfg)
+    if type_errors:
+        for error in type_errors:
+            print(f"ERROR: {error}", file=sys.stderr)
+        sys.exit(1)
+    
+    ensure_ssh_master(cfg['proxmox_host'], cfg)
     
     try:
         # Get apt-cache container name from config
         apt_cache_ct_name = cfg.get('apt-cache-ct', 'apt-cache')
         
-        # Create apt-cache container FIRST (before templates)
+        # Split containers in a single pass: apt-cache (created FIRST, before
+        # templates), swarm containers (handled by deploy_swarm) and the rest
         containers = cfg['containers']
         apt_cache_container = None
+        non_swarm_containers = []
         for c in containers:
             if c['name'] == apt_cache_ct_name:
-                apt_cache_container = c
-                break
-        
+                if apt_cache_container is None:
+                    apt_cache_container = c
+            elif c['type'] not in ('swarm-manager', 'swarm-node'):
+                non_swarm_containers.append(c)
+
         step = 1
         templates = cfg['templates']
-        non_swarm_containers = [c for c in containers if c['type'] not in ['swarm-manager', 'swarm-node']]
-        # Remove apt-cache from non_swarm_containers since we handle it separately
-        non_swarm_containers = [c for c in non_swarm_containers if c['name'] != apt_cache_ct_name]
-        
-        total_steps = (1 if apt_cache_container else 0) + len(templates) + len(non_swarm_containers) + 1 + 1  # apt-cache + templates + containers + swarm + glusterfs
+
+        # apt-cache + templates + containers + swarm + glusterfs
+        total_steps = (1 if apt_cache_container else 0) + len(templates) + len(non_swarm_containers) + 2
         
         if apt_cache_container:
             print(f"\n[{step}/{total_steps}] Creating apt-cache container first...")
@@ -2014,27 +2717,8 @@ def cmd_deploy():
             proxmox_host = cfg['proxmox_host']
             container_id = apt_cache_container['id']
             
-            # Check if apt-cacher-ng service is running
-            max_attempts = 10
-            for i in range(1, max_attempts + 1):
-                service_check = pct_exec(proxmox_host, container_id,
-                                        "systemctl is-active apt-cacher-ng 2>/dev/null || echo 'inactive'",
-                                        check=False, capture_output=True, timeout=10, cfg=cfg)
-                if service_check and "active" in service_check:
-                    # Test if port is accessible
-                    port_check = pct_exec(proxmox_host, container_id,
-                                         f"nc -z localhost {apt_cache_port} 2>/dev/null && echo 'port_open' || echo 'port_closed'",
-                                         check=False, capture_output=True, timeout=10, cfg=cfg)
-                    if port_check and "port_open" in port_check:
-                        print(f"  ✓ apt-cache service is ready on {apt_cache_ip}:{apt_cache_port}", flush=True)
-                        break
-                if i < max_attempts:
-                    print(f"  Waiting for apt-cache service... ({i}/{max_attempts})", flush=True)
-                    time.sleep(3)
-                else:
-                    print(f"  ✗ ERROR: apt-cache service is not ready after {max_attempts} attempts", flush=True)
-                    print(f"  Cannot proceed with template creation without apt-cache", flush=True)
-                    sys.exit(1)
+            if not wait_for_apt_cache(proxmox_host, container_id, apt_cache_ip, apt_cache_port, cfg=cfg):
+                sys.exit(1)
             
             step += 1
         else:
@@ -2048,11 +2732,20 @@ def cmd_deploy():
                 sys.exit(1)
             step += 1
         
-        # Create other containers (excluding swarm containers which are handled separately)
-        for container_cfg in non_swarm_containers:
-            if not create_container(container_cfg, cfg, step, total_steps):
+        # Create other containers (excluding swarm containers which are handled separately);
+        # they target independent container IDs, so build them in parallel
+        # (each build's lines are prefixed with its container name so the logs stay readable)
+        if non_swarm_containers:
+            with prefixed_output(), \
+                    ThreadPoolExecutor(max_workers=min(cfg['parallel_builds'], len(non_swarm_containers))) as executor:
+                futures = {executor.submit(run_prefixed, f"[{container_cfg['name']}] ", create_container,
+                                           container_cfg, cfg, step + i, total_steps): container_cfg
+                           for i, container_cfg in enumerate(non_swarm_containers)}
+                failed = [futures[f]['name'] for f in as_completed(futures) if not f.result()]
+            if failed:
+                print(f"ERROR: Failed to create container(s): {', '.join(failed)}", file=sys.stderr)
                 sys.exit(1)
-            step += 1
+            step += len(non_swarm_containers)
         
         # Deploy swarm (creates swarm containers)
         swarm_step = step
@@ -2067,15 +2760,13 @@ def cmd_deploy():
         if not setup_glusterfs(cfg):
             sys.exit(1)
         
-        print("\n" + "=" * 50)
-        print("Deployment Complete!")
-        print("=" * 50)
+        print_banner("Deployment Complete!", leading_newline=True)
         print(f"\nContainers:")
         for ct in containers:
             print(f"  - {ct['id']}: {ct['name']} ({ct['ip_address']})")
         
         # Show services
-        manager_configs = [c for c in cfg['containers'] if c['type'] == 'swarm-manager']
+        manager_configs = cfg['containers_by_type'].get('swarm-manager', [])
         if manager_configs:
             manager = manager_configs[0]
         print(f"\nPortainer: https://{manager['ip_address']}:{cfg['portainer_port']}")
@@ -2089,8 +2780,8 @@ def cmd_deploy():
         haproxy_containers = [c for c in containers if c['type'] == 'haproxy']
         if haproxy_containers:
             haproxy = haproxy_containers[0]
-        params = haproxy.get('params', {})
-        print(f"HAProxy: http://{haproxy['ip_address']}:{params.get('http_port', 80)} (Stats: http://{haproxy['ip_address']}:{params.get('stats_port', 8404)})")
+        ports = haproxy_ports(haproxy)
+        print(f"HAProxy: http://{haproxy['ip_address']}:{ports['http_port']} (Stats: http://{haproxy['ip_address']}:{ports['stats_port']})")
         if cfg.get('glusterfs'):
             gluster_cfg = cfg['glusterfs']
         print(f"\nGlusterFS:")
@@ -2099,7 +2790,6 @@ def cmd_deploy():
         
     except Exception as e:
         print(f"Error during deployment: {e}", file=sys.stderr)
-        import traceback
         traceback.print_exc()
         sys.exit(1)
 
@@ -2110,14 +2800,13 @@ def cmd_cleanup():
         cfg = get_config()
     except Exception as e:
         print(f"Error loading configuration: {e}", file=sys.stderr)
-        import traceback
         traceback.print_exc()
         sys.exit(1)
     
+    ensure_ssh_master(cfg['proxmox_host'], cfg)
+    
     try:
-        print("=" * 50)
-        print("Cleaning Up Lab Environment")
-        print("=" * 50)
+        print_banner("Cleaning Up Lab Environment")
         print("\nDestroying ALL containers and templates...", flush=True)
     
         print("\nStopping and destroying containers...", flush=True)
@@ -2178,12 +2867,11 @@ def cmd_cleanup():
                 check=False, cfg=cfg)
         print("  ✓ Templates removed", flush=True)
         
-        print("\n" + "=" * 50)
-        print("Cleanup Complete!")
-        print("=" * 50)
+        print_banner("Cleanup Complete!", leading_newline=True)
+        # The lab is gone, so there is nothing left to reuse the connection for
+        stop_ssh_master(cfg['proxmox_host'], cfg)
     except Exception as e:
         print(f"Error during cleanup: {e}", file=sys.stderr)
-        import traceback
         traceback.print_exc()
         sys.exit(1)
 
@@ -2192,44 +2880,48 @@ def cmd_status():
     """Show current lab status"""
     cfg = get_config()
     
-    print("=" * 50)
-    print("Lab Status")
-    print("=" * 50)
+    print_banner("Lab Status")
+    
+    # Containers, templates and swarm state in one SSH round trip, split on section markers
+    template_dir = cfg['proxmox_template_dir']
+    manager_configs = cfg['containers_by_type'].get('swarm-manager', [])
+    status_cmd = (
+        "echo ===containers===; pct list; "
+        "echo ===templates===; "
+        f"ls -lh {template_dir}/*.tar.zst 2>/dev/null || echo 'No templates'"
+    )
+    if manager_configs:
+        manager_id = manager_configs[0]['id']
+        status_cmd += ("; echo ===swarm===; "
+                       f"pct exec {manager_id} -- docker node ls 2>/dev/null || echo 'Swarm not initialized or manager not available'")
+    output = ssh_exec(cfg["proxmox_host"], status_cmd, check=False, capture_output=True, cfg=cfg)
+    
+    sections = {}
+    current = None
+    for line in (output or "").split('\n'):
+        if line.startswith("===") and line.endswith("==="):
+            current = line.strip('=')
+            sections[current] = []
+        elif current:
+            sections[current].append(line)
     
     # Check containers
     print("\nContainers:")
-    result = ssh_exec(cfg["proxmox_host"], "pct list", check=False, capture_output=True, cfg=cfg)
-    if result:
-        print(result)
-    else:
-        print("  No containers found")
+    result = "\n".join(sections.get('containers', [])).strip()
+    print(result if result else "  No containers found")
     
     # Check templates
-    template_dir = cfg['proxmox_template_dir']
     print("\nTemplates:")
-    result = ssh_exec(cfg["proxmox_host"],
-                     f"ls -lh {template_dir}/*.tar.zst 2>/dev/null || echo 'No templates'",
-                     check=False, capture_output=True, cfg=cfg)
-    if result:
-        print(result)
-    else:
-        print("  No templates found")
+    result = "\n".join(sections.get('templates', [])).strip()
+    print(result if result else "  No templates found")
     
     # Check swarm status
     print("\nDocker Swarm:")
-    # Get manager from containers
-    manager_configs = [c for c in cfg['containers'] if c['type'] == 'swarm-manager']
     if not manager_configs:
         print("No swarm manager found")
         return
-    manager_id = manager_configs[0]['id']
-    result = pct_exec(cfg["proxmox_host"], manager_id,
-                    "docker node ls 2>/dev/null || echo 'Swarm not initialized or manager not available'",
-                    check=False, capture_output=True, cfg=cfg)
-    if result:
-        print(result)
-    else:
-        print("  Swarm not available")
+    result = "\n".join(sections.get('swarm', [])).strip()
+    print(result if result else "  Swarm not available")
 
 
 def main():
@@ -2253,7 +2945,10 @@ def main():
     args = parser.parse_args()
     
     if hasattr(args, 'func'):
-        args.func()
+        try:
+            args.func()
+        finally:
+            close_ssh_clients()
     else:
         parser.print_help()
 